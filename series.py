@@ -26,50 +26,310 @@
 # Options --------------------------------------------------------------
 #
 version=0.1
+dbVersion = 2
 dbFile = "series.db"
 tmplFile = "template"
 buildString = "build"
 debug = False
 
-shortOpts = "abdfhimprst:V:C:F:O:T:"
+shortOpts = "abdfhimprst:yj:V:C:F:O:T:"
 longOpts = [
 			"add","all","auto","build","case=",
-			"cases","clean","copy=","createDB=","db=",
-			"default","delete","exact","export","help","file=","files",
-			"force","withOptions","interactive",
-			"name=","modify","option=",
-			"options","print","reset","run","runFile=","series",
-			"template=","type=","value=","version"
+			"cases","clean","copy=","createDB=","daemon","db=",
+			"busyTimeout=","default","delete","exact","export","help","file=","files",
+			"force","format=","gc","history","import=","withOptions","interactive","jobs=","keep=","lineage","link=","lock=",
+			"name=","modify","noDaemon","option=",
+			"options","print","profile","reset","run","runFile=","series",
+			"stopDaemon","sweep=","table=","template=","timeout=","type=","value=","version","wal","where=","yes"
 			]
 
 seriesOptions = ("runFiles","seriesName","templateFiles","templateString")
+identityOptions = ("seriesName",)
+linkModes = ("copy","reflink","hardlink","symlink")
+lockPolicies = ("wait","skip")
 metaOptions = ("_caseName","_seriesName")
 
+# Size of blocks files are read in
+chunkSize = 1048576
+
+# Seconds to wait for other connections to release the data base
+busyTimeout = 60
+
+# Set by main, a session or the daemon
+opts = []
+optNames = []
+sqlCurs = None
+workerPool = None
+captureRunOutput = False
+inWorker = False
+inBatch = False
+profile = None
+
+# Lock files of cases held by this process, with number of holders
+heldLocks = {}
+
+# Options and files of the data base, see getCatalog, and connection
+# and data version they were checked against, see checkCatalog
+catalog = None
+catalogVersion = None
+
+# Parsed template files, see getTemplateEntry
+templateCache = None
+
 #
 # Functions ------------------------------------------------------------
 #
+import collections
+import contextlib
+import csv
 import getopt
+import hashlib
+import itertools
+import multiprocessing
 import os
+import re
+import signal
 import sys
 import shutil
 import subprocess
+import tempfile
+import threading
 import time
 import datetime
+import errno
+import json
+import mmap
+import select
+import socket
+import traceback
+
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
+
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
 
 import sqlite3
 
+# Raised on errors, the command line tool prints the message and exits
+class SeriesError(Exception):
+	pass
+
+# Rows of the options and files tables as kept by the catalog
+OptionRecord = collections.namedtuple('OptionRecord','oid name default fids type')
+FileRecord = collections.namedtuple('FileRecord','fid name templateFid isDirectory')
+
+# Options and files of a data base, by id and by name ignoring case.
+# Loaded at once and dropped when they are changed, see getCatalog
+class Catalog(object):
+	def __init__(self,cursor):
+		self.connection = cursor.connection
+
+		self.options = collections.OrderedDict()
+		self.oids = {}
+		cursor.execute('''
+			SELECT oid,optionName,defaultValue,fidString,optionType
+			FROM options
+			ORDER BY oid''')
+		for oid,name,default,fidString,optType in cursor.fetchall():
+			fids = ()
+			try:
+				fids = tuple(int(f) for f in (fidString or '').split(','))
+			except ValueError:
+				pass
+
+			self.options[oid] = OptionRecord(oid,name,default,fids,optType)
+			self.oids[self.key(name)] = oid
+
+		self.files = collections.OrderedDict()
+		self.fids = {}
+		cursor.execute('''
+			SELECT fid,fileName,templateFid,isDirectory
+			FROM files
+			ORDER BY fid''')
+		for fid,name,templateFid,isDir in cursor.fetchall():
+			self.files[fid] = FileRecord(fid,name,templateFid,isDir == 'yes')
+			self.fids[self.key(name)] = fid
+
+	# Names are compared ignoring case, as by COLLATE NOCASE
+	def key(self,name):
+		if not isinstance(name,type(u"")):
+			name = name.decode('utf-8')
+		return name.lower()
+
+	def file(self,fileName):
+		return self.files.get(self.fids.get(self.key(fileName)))
+
+	def option(self,optName):
+		return self.options.get(self.oids.get(self.key(optName)))
+
+# Timings of phases of a command, statements by call site and bytes
+# read and written. Time of nested phases is subtracted from the outer
+class Profile(object):
+	def __init__(self):
+		self.start = time.time()
+		self.stack = []
+		self.phases = {}
+		self.statements = {}
+		self.bytesRead = 0
+		self.bytesWritten = 0
+
+	def addTime(self,phase,seconds):
+		self.phases[phase] = self.phases.get(phase,0.0) + seconds
+
+	def addStatement(self,site,statement,seconds,calls=1):
+		if site not in self.statements:
+			statement = " ".join(statement.split())
+			self.statements[site] = [0,0.0,statement[:60]]
+
+		entry = self.statements[site]
+		entry[0] += calls
+		entry[1] += seconds
+
+	def enter(self,phase):
+		now = time.time()
+		if self.stack:
+			self.addTime(self.stack[-1][0],now-self.stack[-1][1])
+		self.stack.append([phase,now])
+
+	# Returns innermost phase, None outside of phases
+	def phase(self):
+		if self.stack:
+			return self.stack[-1][0]
+		return None
+
+	def leave(self):
+		now = time.time()
+		phase,start = self.stack.pop()
+		self.addTime(phase,now-start)
+		if self.stack:
+			self.stack[-1][1] = now
+
+	# Adds report of another process, e.g. of a worker
+	def merge(self,report):
+		for phase,seconds in report['phases'].items():
+			self.addTime(phase,seconds)
+
+		for s in report['statements']:
+			self.addStatement(s['site'],s['statement'],s['time'],s['count'])
+
+		self.bytesRead += report['bytesRead']
+		self.bytesWritten += report['bytesWritten']
+
+	def report(self):
+		statements = [ {
+			'site': site,
+			'count': count,
+			'time': seconds,
+			'statement': statement,
+			} for site,(count,seconds,statement) in self.statements.items() ]
+		statements.sort(key=lambda s: -s['time'])
+
+		return {
+			'wall': time.time()-self.start,
+			'phases': self.phases,
+			'statements': statements,
+			'bytesRead': self.bytesRead,
+			'bytesWritten': self.bytesWritten,
+			}
+
+# Cursor counting and timing statements by the function and line they
+# were executed from, while a profile is taken
+class ProfilingCursor(object):
+	phases = ('lookup','db writes')
+
+	def __init__(self,cursor):
+		self.cursor = cursor
+		self.site = None
+
+	def __getattr__(self,name):
+		return getattr(self.cursor,name)
+
+	def __iter__(self):
+		return self
+
+	def execute(self,statement,*args):
+		return self.timed(self.cursor.execute,statement,args)
+
+	def executemany(self,statement,*args):
+		return self.timed(self.cursor.executemany,statement,args)
+
+	def fetchall(self):
+		return self.timedFetch(self.cursor.fetchall)
+
+	def fetchone(self):
+		return self.timedFetch(self.cursor.fetchone)
+
+	def next(self):
+		return self.timedFetch(lambda: next(self.cursor))
+
+	__next__ = next
+
+	def timed(self,method,statement,args):
+		caller = sys._getframe(2)
+		self.site = caller.f_code.co_name+":"+str(caller.f_lineno)
+
+		# Phase is given by the statement unless the call site gives one of
+		# the data base phases by profilePhase, e.g. for reading a PRAGMA
+		phase = profile.phase()
+		if phase not in self.phases:
+			phase = 'db writes'
+			if (statement.lstrip()[:6].upper() == 'SELECT'):
+				phase = 'lookup'
+
+		profile.enter(phase)
+		start = time.time()
+		try:
+			method(statement,*args)
+		finally:
+			profile.addStatement(self.site,statement,time.time()-start)
+			profile.leave()
+
+		return self
+
+	# Time of fetching rows counts for the statement
+	def timedFetch(self,fetch):
+		profile.enter('lookup')
+		start = time.time()
+		try:
+			return fetch()
+		finally:
+			profile.addStatement(self.site,'',time.time()-start,0)
+			profile.leave()
+
+# Output of a command run by the daemon, sent to the client line by line
+class SocketOutput(object):
+	def __init__(self,conn):
+		self.conn = conn
+
+	def write(self,text):
+		if isinstance(text,bytes):
+			text = text.decode('utf-8','replace')
+		try:
+			self.conn.sendall(toBytes(json.dumps({'out': text})+"\n"))
+		except socket.error:
+			pass
+
+	def flush(self):
+		pass
+
+	def isatty(self):
+		return False
+
 # Adds default case and returns its case id
 def addCase(caseName):
 	if debug: print("addCase:",caseName)
 
 	if (len(caseName) == 0):
-		print("Not a valid case name")
-		sys.exit(1)
+		raise SeriesError("Not a valid case name")
 
 	# Check if case already exists
 	if isCase(caseName):
-		print("Case "+caseName+" already exists")
-		sys.exit(1)
+		raise SeriesError("Case "+caseName+" already exists")
 
 	# Add default case
 	cid = addCaseData()
@@ -81,24 +341,97 @@ def addCase(caseName):
 
 	return cid
 
+# Adds many cases with their options at once, cases is a list of pairs
+# of case name and dict of option names and values. Returns list of cids
+def addCases(cases):
+	if debug: print("addCases:",len(cases))
+
+	# Check names of cases against each other and existing cases
+	caseNames = set()
+	for row in sqlCurs.execute('SELECT caseName FROM cases'):
+		caseNames.add(row[0].lower())
+
+	for caseName,values in cases:
+		if (len(caseName) == 0):
+			raise SeriesError("Not a valid case name")
+
+		if caseName.lower() in caseNames:
+			raise SeriesError("Case "+caseName+" already exists")
+
+		caseNames.add(caseName.lower())
+
+	# Look up options once
+	oids = {}
+	for caseName,values in cases:
+		for optName in values:
+			if optName not in oids:
+				oids[optName] = verifyOption(optName,'case')
+
+	# Insert cases, one case instance per case holding all options
+	tstamp = int(time.time())
+	cids = []
+	for i,(caseName,values) in enumerate(cases):
+		sqlCurs.execute('''
+			INSERT INTO caseData (fatherCid,timeCreated)
+			VALUES (0,?)''',(tstamp,))
+		cid = sqlCurs.lastrowid
+		cids.append(cid)
+
+		sqlCurs.execute('''
+			INSERT INTO cases (caseName,currentCid)
+			VALUES (?,?)''',(caseName,cid))
+
+		inserts = [ (cid,oids[o],toText(v)) for o,v in values.items() ]
+		sqlCurs.executemany('''
+			INSERT INTO caseOptions (cid,oid,value)
+			VALUES (?,?,?)''',inserts)
+
+		if (i % 1000 == 0) or (i+1 == len(cases)):
+			printProgress("Adding cases",i+1,len(cases))
+
+	return cids
+
+# Adds cases for all combinations of option values given by --sweep
+# and rows of the table given by --table, named by pattern of --name
+def addCasesBySweep():
+	# Rows of table, or a single empty row
+	rows = [ {} ]
+	if isCmdLineArgument('--table'):
+		rows = readCaseTable(getCmdLineArgument('--table'))
+
+	# Cartesian product of all sweeps, combined with each row
+	sweeps = [ parseSweep(s) for s in getCmdLineArguments('--sweep') ]
+	sweepNames = [ s[0] for s in sweeps ]
+	combinations = list(itertools.product(*[ s[1] for s in sweeps ]))
+
+	cases = []
+	for row in rows:
+		for combination in combinations:
+			values = dict(row)
+			values.update(zip(sweepNames,combination))
+
+			if isCmdLineArgument('--name'):
+				caseName = formatCaseName(getCmdLineArgument('--name'),values)
+				values.pop('caseName',None)
+			elif 'caseName' in values:
+				caseName = values.pop('caseName')
+			else:
+				raise SeriesError("Missing option (--name), or column caseName in table")
+
+			cases.append((caseName,values))
+
+	cids = addCases(cases)
+	print("Added "+str(len(cids))+" cases")
+
 # Adds case by copying an existing and returns its cid
 def addCaseByCopy(caseName,copyCase):
 	# Check if copy case exists and create default
 	ccid = verifyCase(copyCase)
 	cid = addCase(caseName)
 
-	# Need: fatherCid, oidString, valueString
-	sqlCurs.execute('''
-		SELECT oidString,valueString
-		FROM caseData
-		WHERE cid=?''',(ccid,))
-	row = sqlCurs.fetchone()
-
-	insert = (ccid,row[0],row[1],cid)
-	sqlCurs.execute('''
-		UPDATE caseData
-		SET fatherCid=?,oidString=?,valueString=?
-		WHERE cid=?''',insert)
+	# Need: fatherCid and options
+	sqlCurs.execute('UPDATE caseData SET fatherCid=? WHERE cid=?',(ccid,cid))
+	copyOptionsOfCid(ccid,cid)
 
 	return cid
 
@@ -126,21 +459,17 @@ def addCaseByMenu(caseName):
 			continue
 
 		val = raw_input("Value to set: ")
-		oids.append(str(oid))
+		oids.append(oid)
 		vals.append(str(val))
 
 	# If no option specified there is nothing to do, return
 	if (len(oids) == 0): return
 
-	# Build option and value strings and insert
-	oidString = ",".join(oids)
-	valString = ",".join(vals)
-
-	insert = (oidString,valString,cid)
-	sqlCurs.execute('''
-		UPDATE caseData
-		SET oidString=?, valueString=?
-		WHERE cid=?''',insert)
+	# Insert options and values
+	inserts = [ (cid,oid,val) for oid,val in zip(oids,vals) ]
+	sqlCurs.executemany('''
+		INSERT INTO caseOptions (cid,oid,value)
+		VALUES (?,?,?)''',inserts)
 
 	return cid
 
@@ -187,8 +516,7 @@ def addFile(newFile):
 	if debug: print("addFile: ",newFile)
 
 	if (len(newFile) == 0):
-		print("Not a valid file name")
-		sys.exit(1)
+		raise SeriesError("Not a valid file name")
 
 	if (newFile == 'none'):
 		return
@@ -202,8 +530,7 @@ def addFile(newFile):
 	tmplFid = getTemplateFid(newFile)
 	if not tmplFid:
 		delFile(newFile,True)
-		print("Abort.")
-		sys.exit(1)
+		raise SeriesError("Abort.")
 
 	# Insert into DB
 	insert = (newFile,tmplFid)
@@ -211,6 +538,7 @@ def addFile(newFile):
 		INSERT INTO files (fileName,templateFid)
 		VALUES (?,?)''',insert)
 	fid = sqlCurs.lastrowid
+	clearCatalog()
 
 	return fid
 
@@ -233,28 +561,33 @@ def addFileToOption(optFile,optName):
 
 		insert = (fidString,oid)
 		sqlCurs.execute('UPDATE options SET fidString=? WHERE oid=?',insert)
+		clearCatalog()
 
 # Adds option and default value to series
 def addOption(optName,optVal,optType,optFile='none'):
 	verifyOptionType(optType)
 
 	if (len(optName) == 0):
-		print("Expected option name")
-		sys.exit(1)
+		raise SeriesError("Expected option name")
 
 	# Check if valid meta option
 
 
 	# Check if option already exists
 	if isOption(optName,optType):
-		print("Option "+optName+" already available")
-		print("To add a file to this option do not specify the default value")
-		sys.exit(1)
+		raise SeriesError(
+			"Option "+optName+" already available\n"+
+			"To add a file to this option do not specify the default value"
+			)
+
+	# Names are unique across all types of options
+	if isOption(optName):
+		option = getCatalog().option(optName)
+		raise SeriesError("Name already used by "+option.type+" option ("+option.name+")")
 
 	# Check if file is given for case options
 	if (optType == 'case') and (optFile == 'none'):
-		print("Case options need a file")
-		sys.exit(1)
+		raise SeriesError("Case options need a file")
 
 	# Add file if given
 	fid = addFile(optFile)
@@ -265,6 +598,7 @@ def addOption(optName,optVal,optType,optFile='none'):
 			INSERT INTO options (optionName,defaultValue,fidString,optionType)
 			VALUES (?,?,?,?);''',
 			insert)
+	clearCatalog()
 
 # Adds option and value to case
 def addOptionToCase(optName,optValue,caseName,addInstance=True):
@@ -272,8 +606,7 @@ def addOptionToCase(optName,optValue,caseName,addInstance=True):
 	cid = verifyCase(caseName)
 
 	if isOptionSetForCid(optName,cid):
-		print("Option "+optName+" already set for case "+caseName)
-		sys.exit(1)
+		raise SeriesError("Option "+optName+" already set for case "+caseName)
 
 	addOptionToCid(optName,optValue,cid,addInstance)
 
@@ -284,39 +617,23 @@ def addOptionToCid(optName,optValue,cid,addInstance=True):
 	oid = verifyOption(optName)
 
 	if isOptionSetForCid(optName,cid):
-		print("Option "+optName+" already set for case id "+str(cid))
-		sys.exit(1)
+		raise SeriesError("Option "+optName+" already set for case id "+str(cid))
 
-	# Get current option and value string from case
-	sqlCurs.execute('SELECT oidString,valueString FROM caseData WHERE cid=?',(cid,))
-	row = sqlCurs.fetchone()
-	
-	# No options set until now
-	if (row[0] == None) or (len(row[0]) == 0):
-		oidString = str(oid)
-		valString = str(optValue).replace(",","_;_")
-
-	# There are already other options, append
-	else:
-		oidString = row[0] + "," + str(oid)
-		valString = row[1] + "," + str(optValue).replace(",","_;_")
-	
 	# Create new case instance by copy
 	if addInstance:
-		caseName = getCaseName(cid)
 		newCid = addCaseData(cid)
+		copyOptionsOfCid(cid,newCid)
 		updateCurrentCid(cid,newCid)
-		insert = (oidString,valString,newCid)
+		insert = (newCid,oid,str(optValue))
 
 	# Retain current id
 	else:
-		insert = (oidString,valString,cid)
+		insert = (cid,oid,str(optValue))
 
-	# Save values for new case instance
+	# Save value for case instance
 	sqlCurs.execute('''
-		UPDATE caseData
-		SET oidString=?,valueString=?
-		WHERE cid=?''',insert)
+		INSERT INTO caseOptions (cid,oid,value)
+		VALUES (?,?,?)''',insert)
 
 # Adds option with only type specified
 def addOptionWithType(optName,optType):
@@ -325,8 +642,7 @@ def addOptionWithType(optName,optType):
 	# Adding a meta option
 	if (optType == 'meta'):
 		if optName not in metaOptions:
-			print('Not a valid meta option ('+optName+')')
-			sys.exit(1)
+			raise SeriesError('Not a valid meta option ('+optName+')')
 
 		if isCmdLineArgument('--file','-F'):
 			fileName = getCmdLineArgument('--file','-F')
@@ -339,8 +655,7 @@ def addOptionWithType(optName,optType):
 	# Adding a series option
 	elif (optType == 'series'):
 		if optName not in seriesOptions:
-			print('Not a valid meta option ('+optName+')')
-			sys.exit(1)
+			raise SeriesError('Not a valid meta option ('+optName+')')
 
 		# See if value is given
 		if isCmdLineArgument('--value','-V'):
@@ -359,28 +674,26 @@ def addOptionWithType(optName,optType):
 
 	# Do not allow anything else
 	else:
-		print('Please add as standard option')
-		sys.exit(1)
+		raise SeriesError('Please add as standard option')
 
 # Adds template file/directory and returns fid
 def addTemplate(tmplFile):
 	# Check if file is already known to db
 	if isFile(tmplFile):
-		print("Cannot add file a second time ("+tmplFile+")")
-		sys.exit(1)
+		raise SeriesError("Cannot add file a second time ("+tmplFile+")")
 
 	# Check if file contains template string
 	tmplStr = getValueOfOption('templateString')
 	if (tmplFile.find(tmplStr) == -1):
-		print('Could not find template string in file name')
-		print('String:\t'+tmplStr)
-		print('File:\t'+tmplFile)
-		sys.exit(1)
+		raise SeriesError(
+			'Could not find template string in file name\n'+
+			'String:\t'+tmplStr+'\n'+
+			'File:\t'+tmplFile
+			)
 
 	# Find out if file is a directory
 	if not os.path.exists(tmplFile):
-		print("Not a valid file/directory ("+tmplFile+")")
-		sys.exit(1)
+		raise SeriesError("Not a valid file/directory ("+tmplFile+")")
 
 	if os.path.isdir(tmplFile):
 		isDirectory = 'yes'
@@ -393,6 +706,7 @@ def addTemplate(tmplFile):
 		INSERT INTO files (fileName,isDirectory)
 		VALUES (?,?)''',insert)
 	fid = sqlCurs.lastrowid
+	clearCatalog()
 
 	# Update series option containing all template files
 	addFileToOption(tmplFile,'templateFiles')
@@ -407,68 +721,88 @@ def applyOptionsToFile(cid,fileName):
 	# Find out which options are to set here
 	usedOpts = getOptionsUsedInFile(fileName)
 	usedOpts.sort()
-	usedOpts.reverse()
 	if debug: print("applyOptionsToFile: usedOpts,",usedOpts)
 
-	# Read file into list
-	with open(FQFN, "r") as f:
-		initial = f.readlines()
+	# Resolve values and compile the options into a single matcher
+	pattern,tokens = compileOptionsOfCid(cid,usedOpts)
 
-	# Empty file and rewrite it line by line
-	appliedOpts = []
-	with open(FQFN, "w") as f:
+	# Option strings of the template file, scanned once for all cases
+	tPath = getTemplatePath(fileName)
+	with profilePhase('substitution'):
+		matches = []
+		if pattern is not None:
+			matches = getTemplateMatches(tPath,pattern,tokens)
 
-		# Handle line after line
-		for line in initial:
+	# Leave files without option strings as they are, e.g. linked
+	if (len(matches) == 0):
+		if (len(usedOpts) > 0):
+			print("Warning: Options not found in "+fileName+" ("+", ".join(usedOpts)+")")
+		return
 
-			# For every option check if it is used in current line
-			adaptedLine,optsInLine = applyOptionsToString(cid,usedOpts,line)
+	# Splice values into the template while streaming it into a temporary
+	# file next to the case file, which replaces it once it is complete
+	with profilePhase('substitution'):
+		dirName,baseName = os.path.split(FQFN)
+		fd,tmpFile = tempfile.mkstemp(prefix="."+baseName+".",dir=dirName or ".")
+		try:
+			with open(tPath,'rb') as source:
+				with os.fdopen(fd,'wb') as target:
+					read,written,appliedOpts = spliceOptionsIntoFile(
+						matches,tokens,source,target)
 
-			# After every option in this line was handled, write line
-			f.write(adaptedLine)
+			shutil.copymode(FQFN,tmpFile)
+			os.rename(tmpFile,FQFN)
+		except BaseException:
+			if os.path.exists(tmpFile):
+				os.remove(tmpFile)
+			raise
 
-			# Keep track of options used in file
-			for o in optsInLine:
-				if o not in appliedOpts:
-					appliedOpts.append(o)
+	profileBytes(read,written)
 
 	# Warn if not every option assigned to this file was set
-	for opt in appliedOpts:
-		if opt in usedOpts:
-			idx = usedOpts.index(opt)
-			usedOpts.pop(idx)
-
-	if (len(usedOpts) > 0):
-		print("Warning: Options not found in "+fileName+" ("+", ".join(usedOpts)+")")
+	notFound = [ o for o in usedOpts if o not in appliedOpts ]
+	if (len(notFound) > 0):
+		print("Warning: Options not found in "+fileName+" ("+", ".join(notFound)+")")
 
 # Returns a string where all options occuring in input string are
 # replaced by their values, as well as a list of options applied
 def applyOptionsToString(cid,optsUsedInFile,inputString):
-	adaptedString = inputString
-	appliedOpts = []
+	pattern,tokens = compileOptionsOfCid(cid,optsUsedInFile)
+	return substituteOptions(pattern,tokens,inputString)
+
+# Removes lock file of case if it was left by a process that ended, also
+# before it wrote its owner, returns false if the lock is held. Locks of
+# other hosts stay. Processes decide one after another, holding a lock of
+# the data base, so none removes a lock just taken after another process
+# removed the stale one
+def breakStaleLock(lockFile):
+	guard = None
+	if fcntl is not None:
+		guard = open("."+os.path.basename(dbFile)+".lock",'a')
+		fcntl.flock(guard.fileno(),fcntl.LOCK_EX)
 
-	for opt in optsUsedInFile:
-
-		# If option is found in line
-		optStr = 'OPT_'+opt.upper()
-		if (adaptedString.find(optStr) != -1):
-
-			# Replace option string by its value
-			if isOption(opt,'meta'):
-				value = getValueOfMetaOptionOfCid(opt,cid)
-			else:
-				value = getValueOfOptionOfCid(opt,cid)
-			adaptedString = adaptedString.replace(optStr,value)
+	try:
+		owner = getLockOwner(lockFile)
+		try:
+			age = time.time()-os.stat(lockFile).st_mtime
+		except OSError:
+			return True
 
-			# Keep track which options you found in this file
-			if opt not in appliedOpts:
-				appliedOpts.append(opt)
+		if (owner is None):
+			if (age < 5):
+				return False
+		elif (owner[0] != socket.gethostname()) or isProcessAlive(owner[1]):
+			return False
 
-	# Treat caseName as special option
-	#caseName = getCaseName(cid)
-	#adaptedString = adaptedString.replace('OPT_CASENAME','OPT_'+caseName.upper())
+		try:
+			os.remove(lockFile)
+		except OSError:
+			pass
+		return True
 
-	return adaptedString,appliedOpts
+	finally:
+		if guard is not None:
+			guard.close()
 
 # Makes copy of template and applies options
 def buildCid(cid):
@@ -476,29 +810,176 @@ def buildCid(cid):
 	
 	# Get case name (verifies cid)
 	caseName = getCaseName(cid)
-	
-	# Copy template files
-	buildCaseTree(cid)
 
-	# Get files where options are to be applied
-	# File names are not case adapted yet
-	optionFiles = getFiles()
-	if debug: print("buildCid: optionFiles, ",optionFiles)
+	# Other processes must not build, clean or run the case meanwhile.
+	# Returns False if the case is skipped since it is locked
+	with lockedCase(cid) as locked:
+		if not locked:
+			return False
+
+		# Automatic mode, nothing to do if case was built from the same input,
+		# otherwise rewrite only what changed if the case allows to. Only
+		# these builds record the fingerprint of templates and option values
+		fingerprint,digests = '',{}
+		if isCmdLineArgument('--auto'):
+			with profilePhase('fingerprint'):
+				fingerprint,digests = getCaseFingerprint(cid)
+
+			if isBuildUpToDate(cid,fingerprint):
+				print(caseName+' already up to date.')
+				writeBuildFiles(cid,fingerprint,digests)
+				return True
+
+			if rebuildCaseTree(cid,digests):
+				writeBuildFiles(cid,fingerprint,digests)
+				updateCaseBuildData(caseName)
+				commitChanges()
+				return True
+
+		# Copy template files
+		buildCaseTree(cid)
+
+		# Get files where options are to be applied
+		# File names are not case adapted yet
+		optionFiles = getFiles()
+		if debug: print("buildCid: optionFiles, ",optionFiles)
+
+		# Go through all files and gather options to set in that file
+		for fileName in optionFiles:
+			applyOptionsToFile(cid,fileName)
+
+		# Case is complete, record what it was built from
+		writeBuildFiles(cid,fingerprint,digests)
+
+		# Update case entry for last build. Committed right away, so the data
+		# base is locked only for the update and not while files are written
+		updateCaseBuildData(caseName)
+		commitChanges()
+
+		return True
 
-	# Go through all files and gather options to set in that file
-	for fileName in optionFiles:
-		applyOptionsToFile(cid,fileName)
+# Builds multiple cids concurrently in a pool of worker processes,
+# prints a summary and raises SeriesError if any build failed
+def buildCids(cids):
+	if debug: print("buildCids:",cids)
 
-	# Update case entry for last build
-	updateCaseBuildData(caseName)
+	if not isCmdLineArgument('--auto') \
+		and not isCmdLineArgument('--force','-f'):
+		raise SeriesError("Use --auto or --force when building multiple cases")
+
+	jobs = min(getJobs(),len(cids))
+	tasks = [ (cid,opts,False) for cid in cids ]
+
+	# Build in this process if there is nothing to run in parallel, or
+	# within a batch, whose changes are not visible to other processes
+	pool = None
+	if (jobs > 1) and not inBatch:
+		pool = getWorkerPool(jobs)
+		results = pool.imap_unordered(buildCidWorker,tasks)
+	else:
+		results = ( buildCidWorker(t) for t in tasks )
+
+	failed = []
+	skipped = []
+	with profilePhase('wait for workers' if pool else 'build'):
+		for caseName,status,output,report in results:
+			mergeProfile(report)
+			sys.stdout.write(output)
+			if (status == 'done'):
+				print(caseName+": done")
+			elif (status == 'skipped'):
+				skipped.append(caseName)
+			else:
+				print(caseName+": FAILED")
+				failed.append(caseName)
+
+	if pool:
+		releaseWorkerPool(pool)
+
+	built = len(cids)-len(failed)-len(skipped)
+	if (len(skipped) > 0):
+		print("Built "+str(built)+" of "+str(len(cids))+" cases, skipped "+str(len(skipped)))
+	else:
+		print("Built "+str(built)+" of "+str(len(cids))+" cases")
+	if (len(failed) > 0):
+		raise SeriesError("Failed: "+", ".join(sorted(failed)))
+
+# Builds a cid within a worker, returns case name, status (done, skipped
+# or failed), output and profile of the build if it is profiled. The
+# task holds the cid, command line options and whether the caller
+# holds the lock of the case
+def buildCidWorker(task):
+	global opts,optNames
+	cid,opts,lockHeld = task
+	optNames = [ o[0] for o in opts ]
+
+	# Options may have been changed by the daemon since the last task
+	if inWorker:
+		checkCatalog()
+
+	# Profile of worker is merged into the one of the command
+	if inWorker and isCmdLineArgument('--profile'):
+		startProfile()
+
+	# Lock held by the caller counts as held by the worker meanwhile
+	lockFile = None
+	if lockHeld and inWorker:
+		lockFile = getLockFile(cid)
+		heldLocks[lockFile] = 1
+
+	# Output of workers is passed on with the result, in this process
+	# it is written right away
+	stdout = sys.stdout
+	if inWorker:
+		sys.stdout = StringIO()
+	caseName = str(cid)
+	try:
+		caseName = getCaseName(cid)
+		status = 'done' if buildCid(cid) else 'skipped'
+	except SystemExit as e:
+		status = 'failed' if e.code else 'done'
+	except SeriesError as e:
+		print(e)
+		status = 'failed'
+	except Exception:
+		traceback.print_exc(file=sys.stdout)
+		status = 'failed'
+	finally:
+		output = ""
+		if inWorker:
+			output = sys.stdout.getvalue()
+		sys.stdout = stdout
+		if lockFile:
+			del heldLocks[lockFile]
+
+	# Changes of a failed build are dropped, unless they belong to a batch
+	if (status != 'failed'):
+		commitChanges()
+	elif inWorker or not inBatch:
+		sqlCurs.connection.rollback()
+
+	report = None
+	if inWorker and (profile is not None):
+		report = stopProfile()
+
+	return caseName,status,output,report
 
 # Creates case tree by copying templates
 def buildCaseTree(cid):
 	if debug: print("buildCaseTree:",cid)
 	
 	tmplFiles = getFilesOfOption('templateFiles')
+	linkMode = getLinkMode()
+
+	# Files where options are applied are always copied, unless they do
+	# not contain any option string
+	optionPaths = set()
+	for fileName in getFiles():
+		path = getTemplatePath(fileName)
+		if getTemplateEntry(path)['optionStrings']:
+			optionPaths.add(os.path.normpath(path))
 
-	# Create case files from template files, preserving symlinks
+	# Create case files from template files
 	for tFile in tmplFiles:
 		cFile = buildFQFN(cid,tFile)
 		bFile = getBuildFile(cFile,tFile)
@@ -507,36 +988,25 @@ def buildCaseTree(cid):
 		if os.path.exists(cFile):
 			handleTreeBuildingForExistingCase(cid,cFile,bFile)
 
-		# Copy template data to create new case
-		if os.path.isdir(tFile):
-			#shutil.copytree(tFile,cFile,symlinks=True)		# Preserves symlinks
-			shutil.copytree(tFile,cFile)
-		else:
-			shutil.copy(tFile,cFile)
+		# Copy or link template data to create new case
+		with profilePhase('tree copy'):
+			if os.path.isdir(tFile):
+				materializeTree(tFile,cFile,optionPaths,linkMode)
+			elif os.path.normpath(tFile) in optionPaths:
+				shutil.copy(tFile,cFile)
+				profileCopy(tFile)
+			else:
+				materializeFile(tFile,cFile,linkMode)
 
-		# Write build file
-		with open(bFile,'w') as f:
-			f.write(str(cid))
+		# Write build file, fingerprint follows when build is complete
+		writeBuildFile(bFile,cid)
 
 # Assembles fully qualified file name of file for given cid,
 # i.e. the relative path regarding the script execution directory
 def buildFQFN(cid,fileName):
 	if debug: print("buildFQFN:",cid,fileName)
 
-	# Find out template fid
-	fid = verifyFile(fileName)
-	sqlCurs.execute('SELECT templateFid FROM files WHERE fid=?',(fid,))
-	row = sqlCurs.fetchone()
-	tmplFid = row[0]
-
-	# If file is a template file it is already fully qualified
-	if (tmplFid == 0):
-		FQFN = fileName
-
-	# Prepend template directory to fileName
-	else:
-		tmplDirName = getFileName(tmplFid)
-		FQFN = tmplDirName + "/" + fileName
+	FQFN = getTemplatePath(fileName)
 
 	# Replace template strings by full case name
 	tmplString = getValueOfOption('templateString')
@@ -584,6 +1054,19 @@ def buildOptionsForCid(cid,includeDefaults=False):
 
 	return optNames,optVals,optFiles
 
+# Drops the catalog if the data base was changed by another connection
+# since the last check. Called before each command, outside of
+# transactions, as Python 2 commits them before a PRAGMA
+def checkCatalog():
+	global catalog,catalogVersion
+	with profilePhase('lookup'):
+		sqlCurs.execute('PRAGMA data_version')
+		version = (sqlCurs.connection,sqlCurs.fetchone()[0])
+
+	if (version != catalogVersion):
+		catalog = None
+	catalogVersion = version
+
 # Runs a menu to get the file id, return chosen or new file id
 def chooseFid():
 	print("Known files:")
@@ -603,6 +1086,75 @@ def chooseFid():
 		name = raw_input("Enter name of file (incl. relative path): ")
 		return addFile(name)
 
+# Drops the catalog after options or files were changed, or changes
+# were rolled back
+def clearCatalog():
+	global catalog
+	catalog = None
+
+# Commits changes right away, unless a batch of a session is open, which
+# commits them together at its end
+def commitChanges():
+	if inWorker or not inBatch:
+		sqlCurs.connection.commit()
+
+# Returns a compiled pattern matching the option strings (OPT_NAME) of
+# the given options and a dict mapping each option string to its
+# option name and value for the given cid
+def compileOptionsOfCid(cid,optNames):
+	if debug: print("compileOptionsOfCid:",cid,optNames)
+
+	values = getValuesOfOptionsOfCid(cid,optNames)
+
+	tokens = {}
+	for opt in optNames:
+		tokens['OPT_'+opt.upper()] = (opt,values[opt])
+
+	# Longer option strings first, so the longest one matches
+	# (OPT_AB is not taken for OPT_A followed by B)
+	alternatives = sorted(tokens.keys(),key=len,reverse=True)
+	alternatives = [ re.escape(t) for t in alternatives ]
+	if (len(alternatives) == 0):
+		return None,tokens
+
+	pattern = re.compile("|".join(alternatives))
+
+	return pattern,tokens
+
+# Returns connection to data base. Connections wait for each other up to
+# --busyTimeout seconds. With --wal the data base is switched to WAL mode
+# for good, so readers do not block writers and the other way round. It
+# is not the default since WAL does not work on network file systems
+def connectDB(dbName):
+	timeout = busyTimeout
+	if isCmdLineArgument('--busyTimeout'):
+		timeout = getCmdLineArgument('--busyTimeout')
+		if not isNumber(timeout) or (float(timeout) < 0):
+			raise SeriesError("Not a valid busy timeout ("+timeout+")")
+		timeout = float(timeout)
+
+	sqlCon = sqlite3.connect(dbName,timeout=timeout)
+	sqlCon.create_function('toNumber',1,toNumber)
+
+	# Stays in its journal mode if it cannot be changed, e.g. read-only
+	if isCmdLineArgument('--wal'):
+		try:
+			sqlCon.execute('PRAGMA journal_mode=WAL')
+		except sqlite3.OperationalError:
+			pass
+
+	return sqlCon
+
+# Copies all options and values set for one cid to another cid
+def copyOptionsOfCid(fromCid,toCid):
+	if debug: print("copyOptionsOfCid:",fromCid,toCid)
+
+	sqlCurs.execute('''
+		INSERT INTO caseOptions (cid,oid,value)
+		SELECT ?,oid,value
+		FROM caseOptions
+		WHERE cid=?''',(toCid,fromCid))
+
 # Creates a new database
 def createDB(dbName):
 	global sqlCurs
@@ -610,14 +1162,14 @@ def createDB(dbName):
 	dbFile = dbName + ".db"
 
 	if os.path.isfile(dbFile):
-		print("Database already exists ("+dbName+")")
-		sys.exit(1)
+		raise SeriesError("Database already exists ("+dbName+")")
 
-	sqlCon = sqlite3.connect(dbFile)
+	sqlCon = connectDB(dbFile)
 	sqlCurs = sqlCon.cursor()
 
 	# Create tables
 	createTables()
+	sqlCurs.execute('PRAGMA user_version=%d' % dbVersion)
 
 	# Set initial options
 	addOption('seriesName',dbName,'series')
@@ -634,10 +1186,11 @@ def createDB(dbName):
 # Creates tables in fresh data base
 def createTables():
 	#
-	# There are four different tables
+	# There are five different tables
 	#	options		Stores all possible options and their default values
 	#	cases		Stores all case names and the id of current case data
 	#	caseData	Stores all specific information about a case
+	#	caseOptions	Stores the non-default option values of each cid
 	#	files		Stores all file names and their fid
 	#
 
@@ -672,15 +1225,12 @@ def createTables():
 			comment			VARCHAR(1500))
 			''')
 
-	# Create table for case data storing all the options and their
-	# values used by each case
+	# Create table for case data storing the history of each case
 	# Columns:
 	#	cid				Id of case
 	#	fatherCid		Id of father case
 	#	timeCreated		Timestamp of creation
 	#	timeBuild		Timestamp of last use
-	#	oidString		Comma seperated ids of non-default options
-	#	valueString		Comma seperated values of options
 	#	comment			Could be used for user comments
 	sqlCurs.execute('''
 		CREATE TABLE caseData (
@@ -689,11 +1239,11 @@ def createTables():
 			timeCreated			INTEGER NOT NULL,
 			timeBuild			INTEGER DEFAULT 0,
 			builds				INTEGER DEFAULT 0,
-			oidString			VARCHAR(1000),
-			valueString			VARCHAR(1000),
 			comment				VARCHAR(1500))
 			''')
 
+	createCaseOptionsTable()
+
 
 	# Create table for files to be adjusted
 	# Columns:
@@ -708,6 +1258,46 @@ def createTables():
 			)
 			''')
 
+	createIndexes()
+
+# Creates table storing the options set for each cid
+def createCaseOptionsTable():
+	# Columns:
+	#	cid			Id of case
+	#	oid			Id of option set to a non-default value
+	#	value		Value of option
+	sqlCurs.execute('''
+		CREATE TABLE IF NOT EXISTS caseOptions (
+			cid				INTEGER NOT NULL,
+			oid				INTEGER NOT NULL,
+			value			VARCHAR(1000),
+			PRIMARY KEY (cid,oid))
+			''')
+
+	# Allows finding all cids using an option (and value)
+	sqlCurs.execute('''
+		CREATE INDEX IF NOT EXISTS caseOptionsOidValue
+		ON caseOptions (oid,value)''')
+
+# Creates indexes used for looking up names and ids
+def createIndexes():
+	# Names are compared case insensitive, so are the unique indexes
+	sqlCurs.execute('''
+		CREATE UNIQUE INDEX IF NOT EXISTS casesCaseName
+		ON cases (caseName COLLATE NOCASE)''')
+	sqlCurs.execute('''
+		CREATE INDEX IF NOT EXISTS casesCurrentCid
+		ON cases (currentCid)''')
+	sqlCurs.execute('''
+		CREATE UNIQUE INDEX IF NOT EXISTS optionsOptionName
+		ON options (optionName COLLATE NOCASE)''')
+	sqlCurs.execute('''
+		CREATE UNIQUE INDEX IF NOT EXISTS filesFileName
+		ON files (fileName COLLATE NOCASE)''')
+	sqlCurs.execute('''
+		CREATE INDEX IF NOT EXISTS caseDataFatherCid
+		ON caseData (fatherCid)''')
+
 # Deletes all files created during build of given case
 def delBuildCase(cid,force=False):
 	if debug: print("delBuildCase:",cid)
@@ -721,19 +1311,23 @@ def delBuildCase(cid,force=False):
 
 	tmplFiles = getFilesOfOption('templateFiles')
 
-	for tFile in tmplFiles:
-		cFile = buildFQFN(cid,tFile)
-		bFile = getBuildFile(cFile,tFile)
-		
-		if os.path.isdir(cFile):
-			shutil.rmtree(cFile)
-		elif os.path.isfile(cFile):
-			os.remove(cFile)
-		else:
-			print('Nothing to delete.')
+	with lockedCase(cid) as locked:
+		if not locked:
+			return
+
+		for tFile in tmplFiles:
+			cFile = buildFQFN(cid,tFile)
+			bFile = getBuildFile(cFile,tFile)
 
-		if os.path.isfile(bFile):
-			os.remove(bFile)
+			if os.path.isdir(cFile):
+				shutil.rmtree(cFile)
+			elif os.path.isfile(cFile):
+				os.remove(cFile)
+			else:
+				print('Nothing to delete.')
+
+			if os.path.isfile(bFile):
+				os.remove(bFile)
 
 # Deletes given case and all fathers
 def delCase(caseName,force=False):
@@ -796,6 +1390,7 @@ def delCid(cid,deleteRecursive=True,depth=0):
 		delCid(fatherCid,True,depth+1)
 
 	# After recursive call delete current entry
+	sqlCurs.execute('DELETE FROM caseOptions WHERE cid=?',(cid,))
 	sqlCurs.execute('DELETE FROM caseData WHERE cid=?',(cid,))
 
 # Deletes options with default values from case
@@ -822,17 +1417,14 @@ def delFile(fileName,force=False):
 
 	# Delete file from files table
 	sqlCurs.execute('DELETE FROM files WHERE fid=?',(fid,))
+	clearCatalog()
 
 # Removes file from already set up option
 def delFileFromOption(optName,optFile):
 	oid = verifyOption(optName)
 	fid = verifyFile(optFile)
 
-	# Get current fidString
-	sqlCurs.execute('SELECT fidString FROM options WHERE oid=?',(oid,))
-	row = sqlCurs.fetchone()
-	fids = row[0].split(',')
-	fids = map(int,fids)
+	fids = getFidsOfOid(oid)
 
 	# Find out if file is already set, if yes delete, if not do nothing
 	if fid in fids:
@@ -841,26 +1433,117 @@ def delFileFromOption(optName,optFile):
 
 		insert = (fidString,oid)
 		sqlCurs.execute('UPDATE options SET fidString=? WHERE oid=?',insert)
+		clearCatalog()
+
+# Deletes case instances that are not needed anymore, in one transaction.
+# Kept are the current instances of cases, the keep latest instances
+# before them and the instances cases were built from, according to
+# their build files. Kept instances get the nearest kept ancestor as
+# father, instances of deleted cases are deleted
+def delHistory(keep=0,force=False):
+	if debug: print("delHistory:",keep,force)
+
+	fathers = dict(sqlCurs.execute('SELECT cid,fatherCid FROM caseData'))
+	currentCids = [ r[0] for r in sqlCurs.execute('SELECT currentCid FROM cases') ]
+
+	# Current instances and their history according to retention
+	kept = set()
+	for cid in currentCids:
+		kept.add(cid)
+		for i in range(keep):
+			cid = fathers.get(cid,0)
+			if not cid or (cid in kept): break
+			kept.add(cid)
+
+	# Instances cases were built from
+	tmplFiles = getFilesOfOption('templateFiles')
+	for cid in currentCids:
+		for tFile in tmplFiles:
+			bFile = getBuildFile(buildFQFN(cid,tFile),tFile)
+			if os.path.isfile(bFile):
+				buildCid = getBuildCid(bFile)
+				if buildCid in fathers:
+					kept.add(buildCid)
+
+	unused = [ cid for cid in fathers if cid not in kept ]
+	if (len(unused) == 0):
+		print("Nothing to delete, keeping "+str(len(kept))+" case instances")
+		return
+
+	if not force:
+		print("Deleting "+str(len(unused))+" of "+str(len(fathers))+" case instances")
+		answer = raw_input("Proceed? (Y/n): ")
+		if (answer != 'Y'):
+			print("Abort.")
+			sys.exit(0)
+
+	# Nearest kept ancestor as father
+	moves = []
+	for cid in kept:
+		father = fathers[cid]
+		seen = set()
+		while father and (father not in kept) and (father not in seen):
+			seen.add(father)
+			father = fathers.get(father,0)
+
+		if father in seen:
+			father = 0
+		if (father != fathers[cid]):
+			moves.append((father,cid))
+
+	# Read before the first write, Python 2 commits before a PRAGMA, so
+	# not within a batch
+	if not inBatch:
+		with profilePhase('lookup'):
+			freeBefore = sqlCurs.execute('PRAGMA freelist_count').fetchone()[0]
+			pageSize = sqlCurs.execute('PRAGMA page_size').fetchone()[0]
+
+	# Only DML statements, so all changes are committed at once
+	try:
+		numValues = 0
+		chunk = 500
+		for first in range(0,len(unused),chunk):
+			cids = unused[first:first+chunk]
+			marks = ",".join("?"*len(cids))
+			sqlCurs.execute(
+				'DELETE FROM caseOptions WHERE cid IN ('+marks+')',cids)
+			numValues += sqlCurs.rowcount
+			sqlCurs.execute(
+				'DELETE FROM caseData WHERE cid IN ('+marks+')',cids)
+
+		sqlCurs.executemany('UPDATE caseData SET fatherCid=? WHERE cid=?',moves)
+		commitChanges()
+	except BaseException:
+		if not inBatch:
+			sqlCurs.connection.rollback()
+		raise
+
+	print("Deleted "+str(len(unused))+" of "+str(len(fathers))+" case instances"
+		+" and "+str(numValues)+" option values")
+	if not inBatch:
+		with profilePhase('lookup'):
+			freeAfter = sqlCurs.execute('PRAGMA freelist_count').fetchone()[0]
+		freed = (freeAfter-freeBefore)*pageSize
+		print("Freed "+str(freed//1024)+" KiB in data base, run VACUUM to shrink the file")
 
 # Deletes given option
-def delOption(optName):
+def delOption(optName,force=False):
 	oid = verifyOption(optName)
 
-	print("Warning: Deleting an option leads to unavoidable loss of data!")
-	print("If you are not absolutely sure, delete the option from cases instead.")
-	answer = raw_input("Proceed? (Y/n): ")
-	if (answer != 'Y'):
-		print("Abort.")
-		sys.exit(0)
+	if not force:
+		print("Warning: Deleting an option leads to unavoidable loss of data!")
+		print("If you are not absolutely sure, delete the option from cases instead.")
+		answer = raw_input("Proceed? (Y/n): ")
+		if (answer != 'Y'):
+			print("Abort.")
+			sys.exit(0)
 
-	# Run through all cids and remove option from option/valueString
-	for row in sqlCurs.execute('''SELECT cid FROM caseData'''):
-		cid = row[0]
-		if isOptionSetForCid(optName,cid):
-			delOptionFromCid(optName,cid,False)
+	# Remove option from all cids
+	sqlCurs.execute('DELETE FROM caseOptions WHERE oid=?',(oid,))
 
 	# Delete option entry
 	sqlCurs.execute('DELETE FROM options WHERE oid=?',(oid,))
+	clearCatalog()
 
 # Delete option from a case
 def delOptionFromCase(optName,caseName,addInstance=True):
@@ -875,37 +1558,17 @@ def delOptionFromCid(optName,cid,addInstance=True):
 	if not isOptionSetForCid(optName,cid):
 		return
 
-	# Get option and value strings
-	sqlCurs.execute('SELECT oidString,valueString FROM caseData WHERE cid=?',(cid,))
-	row = sqlCurs.fetchone()
-	oids = row[0].split(',')
-	oids = map(int,oids)
-	vals = row[1].split(',')
-
-	# Remove
-	idx = oids.index(oid)
-	oids.pop(idx)
-	vals.pop(idx)
-
-	# Update
-	oidString = ",".join(str(o) for o in oids)
-	valString = ",".join(vals)
-
 	# Create or create not new case instance
 	if addInstance:
 		newCid = addCaseData(cid)
-		caseName = getCaseName(cid)
+		copyOptionsOfCid(cid,newCid)
 		updateCurrentCid(cid,newCid)
-		insert = (oidString,valString,newCid)
-	else:
-		insert = (oidString,valString,cid)
+		cid = newCid
 
 	# Update DB
 	sqlCurs.execute('''
-		UPDATE caseData
-		SET oidString=?,valueString=?
-		WHERE cid=?''',
-		insert)
+		DELETE FROM caseOptions
+		WHERE cid=? AND oid=?''',(cid,oid))
 		
 def export():
 	if debug: print('export')
@@ -933,17 +1596,114 @@ def export():
 def exportCases():
 	if debug: print('exportCases')
 
-	allCases = []
-	for row in sqlCurs.execute('SELECT caseName FROM cases ORDER BY caseName'):
-		allCases.append(row[0])
-
-	for case in allCases:
+	for case,cid,opts in iterCasesWithOptions():
 		print('series -a -C '+case)
 
-		opts,vals,files = buildOptionsForCase(case)
-		for o,v in zip(opts,vals):
+		for o,v in opts:
 			print('series -a -C '+case+' -O '+o+" -V \'"+v+"\'")
 
+# Exports cases and their non-default option values as CSV table, empty
+# cells stand for default values
+def exportCSV():
+	if debug: print('exportCSV')
+
+	optNames = sorted(getOptions(['case']),key=lambda o: o.lower())
+
+	writer = csv.writer(sys.stdout)
+	writer.writerow(['caseName']+optNames)
+
+	for case,cid,opts in iterCasesWithOptions():
+		values = dict(opts)
+		writer.writerow([ toStr(v) for v in
+			[case]+[ values.get(o,'') for o in optNames ] ])
+
+# Exports whole series as JSON document in one pass, including options,
+# files and cases with their option values. Only current case instances
+# are exported unless withHistory is set
+def exportJSON(withHistory=False):
+	if debug: print('exportJSON',withHistory)
+
+	out = sys.stdout
+	curs = getCursor()
+	out.write('{\n"format": 1,\n')
+
+	# Options including series options
+	options = []
+	for row in curs.execute('''
+			SELECT oid,optionName,defaultValue,fidString,optionType,comment
+			FROM options
+			ORDER BY oid'''):
+		fids = [ int(f) for f in (row[3] or '').split(',') if f ]
+		options.append({
+			'oid': row[0],
+			'optionName': row[1],
+			'defaultValue': row[2],
+			'fids': fids,
+			'optionType': row[4],
+			'comment': row[5],
+			})
+	writeJSONList(out,'options',options)
+
+	# Files
+	files = ( {
+			'fid': row[0],
+			'fileName': row[1],
+			'templateFid': row[2],
+			'isDirectory': row[3],
+			} for row in curs.execute('''
+			SELECT fid,fileName,templateFid,isDirectory
+			FROM files
+			ORDER BY fid''') )
+	writeJSONList(out,'files',files)
+
+	# Case instances and their options
+	if withHistory:
+		query = '''
+			SELECT caseData.cid,fatherCid,timeCreated,timeBuild,builds,
+				caseData.comment,optionName,value
+			FROM caseData
+			LEFT JOIN caseOptions ON caseOptions.cid=caseData.cid
+			LEFT JOIN options ON options.oid=caseOptions.oid
+			ORDER BY caseData.cid'''
+	else:
+		query = '''
+			SELECT caseData.cid,0,timeCreated,timeBuild,builds,
+				caseData.comment,optionName,value
+			FROM caseData
+			JOIN cases ON cases.currentCid=caseData.cid
+			LEFT JOIN caseOptions ON caseOptions.cid=caseData.cid
+			LEFT JOIN options ON options.oid=caseOptions.oid
+			ORDER BY caseData.cid'''
+
+	def caseData():
+		rows = curs.execute(query)
+		for cid,group in itertools.groupby(rows,lambda r: r[0]):
+			group = list(group)
+			row = group[0]
+			yield {
+				'cid': cid,
+				'fatherCid': row[1],
+				'timeCreated': row[2],
+				'timeBuild': row[3],
+				'builds': row[4],
+				'comment': row[5],
+				'options': dict((r[6],r[7]) for r in group if r[6] is not None),
+				}
+	writeJSONList(out,'caseData',caseData())
+
+	# Cases
+	cases = ( {
+			'caseName': row[0],
+			'currentCid': row[1],
+			'comment': row[2],
+			} for row in curs.execute('''
+			SELECT caseName,currentCid,comment
+			FROM cases
+			ORDER BY caseName''') )
+	writeJSONList(out,'cases',cases,True)
+
+	out.write('}\n')
+
 def exportFiles():
 	if debug: print('exportFiles')
 
@@ -997,10 +1757,13 @@ def exportOptions():
 				print('series -a -O '+optName+' -F '+fName)
 
 # Returns lists of options and arguments
-def getArgs(shortOpts,longOpts):
+def getArgs(shortOpts,longOpts,argv=None):
+	if argv is None:
+		argv = sys.argv[1:]
+
 	try:
 		opts, args = getopt.getopt(
-			sys.argv[1:],
+			argv,
 			shortOpts,
 			longOpts)
 	except getopt.GetoptError:
@@ -1011,6 +1774,139 @@ def getArgs(shortOpts,longOpts):
 	# args: List of arguments that could not be matched with an option
 	return opts,args
 
+# Returns name of case given by pattern, e.g. run-{mesh}-{solver}, and
+# the values of options
+def formatCaseName(pattern,values):
+	try:
+		return pattern.format(**values)
+	except KeyError as e:
+		raise SeriesError("Name pattern uses unknown option ("+str(e.args[0])+")")
+	except (IndexError,ValueError):
+		raise SeriesError("Not a valid name pattern ("+pattern+")")
+
+# Forwards command to daemon serving the DB, returns its exit status, or
+# None if no daemon is running or it serves another directory
+def forwardToDaemon(socketFile,argv):
+	if not os.path.exists(socketFile):
+		return None
+
+	client = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+	try:
+		client.connect(socketFile)
+	except socket.error:
+		return None
+
+	request = {'argv': argv, 'cwd': os.getcwd()}
+	try:
+		client.sendall(toBytes(json.dumps(request)+"\n"))
+	except socket.error:
+		return None
+
+	status = 1
+	for line in client.makefile('r'):
+		message = json.loads(line)
+		if 'out' in message:
+			out = message['out']
+			if not isinstance(out,str):
+				out = out.encode('utf-8')
+			sys.stdout.write(out)
+			sys.stdout.flush()
+		elif 'rejected' in message:
+			status = None
+			break
+		elif 'exit' in message:
+			status = message['exit']
+			break
+
+	client.close()
+	return status
+
+# Passes all output of run file process available so far on to
+# sys.stdout, if it is captured
+def forwardRunOutput(case,finished=False):
+	pipe = case['process'].stdout
+	if pipe is None:
+		return
+
+	while True:
+		readable = select.select([pipe],[],[],0)[0]
+		if not readable:
+			break
+
+		data = os.read(pipe.fileno(),65536)
+		if not data:
+			break
+
+		sys.stdout.write(data.decode('utf-8','replace'))
+
+	if finished:
+		pipe.close()
+
+# Returns list of current cids of all cases
+def getAllCids():
+	cids = []
+	for row in sqlCurs.execute('''
+			SELECT currentCid
+			FROM cases
+			ORDER BY caseName'''):
+		cids.append(row[0])
+
+	return cids
+
+# Returns cid and its ancestors, father first, up to the patriarch.
+# Recursive queries are wrapped in a SELECT, as Python 2 commits open
+# transactions before statements starting with WITH
+def getAncestorCids(cid):
+	verifyCid(cid)
+
+	cids = []
+	for row in sqlCurs.execute('''
+			SELECT cid FROM (
+				WITH RECURSIVE lineage(cid,fatherCid,depth) AS (
+					SELECT cid,fatherCid,0 FROM caseData WHERE cid=?
+					UNION ALL
+					SELECT caseData.cid,caseData.fatherCid,lineage.depth+1
+					FROM caseData
+					JOIN lineage ON caseData.cid=lineage.fatherCid
+					WHERE lineage.depth<(SELECT COUNT(*) FROM caseData))
+				SELECT cid,depth FROM lineage)
+			ORDER BY depth''',(cid,)):
+		cids.append(row[0])
+
+	return cids
+
+# Returns widths of columns of case matrix with the given options, from
+# the longest values of options set for cases and their default values
+def getCaseMatrixWidths(optNames,showDefaults=False):
+	sqlCurs.execute('SELECT MAX(LENGTH(caseName)) FROM cases')
+	caseNameWidth = sqlCurs.fetchone()[0] or 0
+
+	lengths = {}
+	for optName,length in sqlCurs.execute('''
+			SELECT options.optionName,MAX(LENGTH(caseOptions.value))
+			FROM cases
+			JOIN caseOptions ON caseOptions.cid=cases.currentCid
+			JOIN options ON options.oid=caseOptions.oid
+			GROUP BY options.oid'''):
+		lengths[optName] = length or 0
+
+	if showDefaults:
+		seriesName = getValueOfOption('seriesName')
+		for optName,optType,value in sqlCurs.execute('''
+				SELECT optionName,optionType,defaultValue
+				FROM options'''):
+			if (optName == '_caseName'):
+				value = 'x'*caseNameWidth
+			elif (optName == '_seriesName'):
+				value = seriesName
+			lengths[optName] = max(lengths.get(optName,0),len(value or ''))
+
+	widths = [ max(len('caseName'),caseNameWidth) ]
+	for optName in optNames:
+		widths.append(max(len(optName),lengths.get(optName,0)))
+
+	return widths
+
 # Returns cid contained in buildFile
 def getBuildCid(buildFile):
 	with open(buildFile,'r') as f:
@@ -1026,6 +1922,31 @@ def getBuildFile(caseFile,templateFile):
 	else:
 		return "." + buildString + "-" + caseFile
 
+# Returns dict of file digests stored in buildFile, None if there are none
+def getBuildDigests(buildFile):
+	with open(buildFile,'r') as f:
+		lines = f.readlines()
+
+	if (len(lines) < 3):
+		return None
+
+	digests = {}
+	for line in lines[2:]:
+		digest,path = line.rstrip("\n").split(" ",1)
+		digests[path] = digest
+
+	return digests
+
+# Returns fingerprint stored in buildFile, None if there is none
+def getBuildFingerprint(buildFile):
+	with open(buildFile,'r') as f:
+		lines = f.readlines()
+
+	if (len(lines) < 2) or (len(lines[1].strip()) == 0):
+		return None
+
+	return lines[1].strip()
+
 # Returns how often given case was already build
 def getCaseBuilds(caseName):
 	cid = verifyCase(caseName)
@@ -1034,11 +1955,53 @@ def getCaseBuilds(caseName):
 	row = sqlCurs.fetchone()
 	return row[0]
 
+# Returns fingerprint of what a build of cid consists of, i.e. a hash
+# over the contents of all template files and the values of all options,
+# and a dict of the digests of the files of each template file. The
+# digest of a file covers the digest of its content, as cached by
+# getTemplateEntry, and the values of the options applied to it
+def getCaseFingerprint(cid):
+	if debug: print("getCaseFingerprint:",cid)
+
+	optNames = sorted(getOptions(['case','meta']))
+	values = getValuesOfOptionsOfCid(cid,optNames)
+
+	# Options applied to template paths
+	optionsOfPath = {}
+	for fileName in getFiles():
+		path = os.path.normpath(getTemplatePath(fileName))
+		optionsOfPath[path] = sorted(getOptionsUsedInFile(fileName))
+
+	# Digests of all files of the templates
+	digests = {}
+	for tFile in getFilesOfOption('templateFiles'):
+		digests[tFile] = {}
+		for path in listTemplateFiles(tFile):
+			digest = hashlib.sha1()
+			digest.update(toBytes(getTemplateEntry(path,False)['sha1']+"\0"))
+			for opt in optionsOfPath.get(path,[]):
+				digest.update(toBytes(opt+"\0"+str(values[opt])+"\0"))
+			digests[tFile][path] = digest.hexdigest()
+
+	if loadTemplateCache()['unsaved']:
+		saveTemplateCache()
+
+	fingerprint = hashlib.sha1()
+	fingerprint.update(toBytes(getCaseName(cid)+"\0"))
+
+	for tFile in sorted(digests):
+		for path in sorted(digests[tFile]):
+			fingerprint.update(toBytes(path+"\0"+digests[tFile][path]+"\0"))
+
+	for opt in optNames:
+		fingerprint.update(toBytes(opt+"\0"+str(values[opt])+"\0"))
+
+	return fingerprint.hexdigest(),digests
+
 # Returns case name of case with given id
 def getCaseName(cid,isCurrentCid=True):
 	if not isCurrentCid:
-		print("Cannot lookup caseNames of non-current cids yet (cid: "+caseName+")")
-		sys.exit(1)
+		raise SeriesError("Cannot lookup caseNames of non-current cids yet (cid: "+caseName+")")
 	
 	verifyCid(cid,isCurrentCid)
 
@@ -1050,15 +2013,183 @@ def getCaseName(cid,isCurrentCid=True):
 	row = sqlCurs.fetchone()
 	return row[0]
 
-# Returns value of given command line option
-def getCmdLineArgument(longOpt,shortOpt="none"):
-	# Use global opts variable
+# Returns catalog of options and files of the data base, loading it
+# for the connection in use if needed
+def getCatalog():
+	global catalog
+	if (catalog is None) or (catalog.connection is not sqlCurs.connection):
+		catalog = Catalog(sqlCurs)
+
+	return catalog
+
+# Returns list of current cids of cases having option set to given value
+def getCidsWithOptionValue(optName,value):
+	oid = verifyOption(optName)
+
+	cids = []
+	for row in sqlCurs.execute('''
+			SELECT cases.currentCid
+			FROM caseOptions
+			JOIN cases ON cases.currentCid=caseOptions.cid
+			WHERE caseOptions.oid=? AND caseOptions.value=?''',
+			(oid,str(value))):
+		cids.append(row[0])
+
+	return cids
+
+# Returns current cids of cases, ordered by name, whose options match all
+# conditions as returned by parseWhere. Options not set for a case have
+# their default value. Cases can be restricted to names containing
+# caseName, or to caseName itself if exact is set
+def getCidsWhere(conditions,caseName=None,exact=False):
+	# One column with the value of each option used in conditions
+	columns = []
+	params = []
+	for i,(optName,op,values) in enumerate(conditions):
+		if isOption(optName,'meta') and (optName.lower() == '_casename'):
+			column = 'caseName'
+		elif isOption(optName,'meta'):
+			column = '?'
+			params.append(getValueOfOption('seriesName'))
+		else:
+			column = '''COALESCE(
+				(SELECT value FROM caseOptions
+				WHERE cid=cases.currentCid AND oid=?),?)'''
+			params += [verifyOption(optName,'case'),getValueOfOption(optName)]
+		columns.append(column+" AS v"+str(i))
+
+	names = ''
+	if exact:
+		names = 'WHERE caseName=? COLLATE NOCASE'
+		params.append(caseName)
+	elif caseName is not None:
+		names = 'WHERE UPPER(caseName) LIKE ?'
+		params.append("%"+caseName.upper()+"%")
+
+	tests = []
+	for i,(optName,op,values) in enumerate(conditions):
+		column = "v"+str(i)
+		marks = ",".join("?"*len(values))
+
+		# Values are compared as numbers if they are one, see toNumber
+		number = "toNumber("+column+")"
+		isNumeric = number+" IS NOT NULL"
+
+		if op in ('in','not in'):
+			test = column+" IN ("+marks+")"
+			params += values
+
+			numbers = [ toNumber(v) for v in values if toNumber(v) is not None ]
+			if numbers:
+				test += " OR ("+isNumeric+" AND "+number+" IN ("+ \
+					",".join("?"*len(numbers))+"))"
+				params += numbers
+
+		elif op in ('between','not between'):
+			test = isNumeric+" AND "+number+" BETWEEN ? AND ?"
+			params += [ toNumber(v) for v in values ]
+
+		else:
+			test = isNumeric+" AND "+number+" "+op+" ?"
+			params.append(toNumber(values[0]))
+
+		if op.startswith('not'):
+			tests.append("NOT ("+test+")")
+		else:
+			tests.append("("+test+")")
+
+	cids = []
+	for row in sqlCurs.execute('''
+			SELECT currentCid
+			FROM (
+				SELECT currentCid,caseName'''+"".join(","+c for c in columns)+'''
+				FROM cases '''+names+''')
+			WHERE '''+(" AND ".join(tests) or "1")+'''
+			ORDER BY caseName''',params):
+		cids.append(row[0])
+
+	return cids
+
+# Returns history of cid from its patriarch on as list of tuples of cid,
+# time of creation, time of last build and dict of options set. See
+# getAncestorCids for the recursive query
+def getCidHistory(cid):
+	verifyCid(cid)
+
+	rows = sqlCurs.execute('''
+		SELECT lineage.cid,caseData.timeCreated,caseData.timeBuild,
+			options.optionName,caseOptions.value
+		FROM (
+			WITH RECURSIVE lineage(cid,fatherCid,depth) AS (
+				SELECT cid,fatherCid,0 FROM caseData WHERE cid=?
+				UNION ALL
+				SELECT caseData.cid,caseData.fatherCid,lineage.depth+1
+				FROM caseData
+				JOIN lineage ON caseData.cid=lineage.fatherCid
+				WHERE lineage.depth<(SELECT COUNT(*) FROM caseData))
+			SELECT cid,depth FROM lineage) AS lineage
+		JOIN caseData ON caseData.cid=lineage.cid
+		LEFT JOIN caseOptions ON caseOptions.cid=lineage.cid
+		LEFT JOIN options ON options.oid=caseOptions.oid
+		ORDER BY lineage.depth DESC''',(cid,))
+
+	history = []
+	for cid,group in itertools.groupby(rows,lambda r: r[0]):
+		group = list(group)
+		options = dict( (r[3],r[4]) for r in group if r[3] is not None )
+		history.append((cid,group[0][1],group[0][2],options))
+
+	return history
+
+# Returns value of given command line option
+def getCmdLineArgument(longOpt,shortOpt="none"):
+	# Use global opts variable
 	for opt,val in opts:
 		if (opt == shortOpt) or (opt == longOpt):
 			return val
 
-	print "Missing option ("+longOpt+"/"+shortOpt+")"
-	sys.exit(1)
+	raise SeriesError("Missing option ("+longOpt+"/"+shortOpt+")")
+
+# Returns another cursor on the connection in use, e.g. to iterate over
+# rows while the global one is used. It is profiled like the global one
+def getCursor():
+	curs = sqlCurs.connection.cursor()
+	if profile is not None:
+		curs = ProfilingCursor(curs)
+
+	return curs
+
+# Returns all descendants of cid, sons first. See getAncestorCids for
+# the recursive query
+def getDescendantCids(cid):
+	verifyCid(cid)
+
+	cids = []
+	for row in sqlCurs.execute('''
+			SELECT cid FROM (
+				WITH RECURSIVE descendants(cid,depth) AS (
+					SELECT cid,1 FROM caseData WHERE fatherCid=?
+					UNION ALL
+					SELECT caseData.cid,descendants.depth+1
+					FROM caseData
+					JOIN descendants ON caseData.fatherCid=descendants.cid
+					WHERE descendants.depth<(SELECT COUNT(*) FROM caseData))
+				SELECT cid,depth FROM descendants)
+			ORDER BY depth,cid''',(cid,)):
+		cids.append(row[0])
+
+	return cids
+
+# Returns list of all values of given command line option, which can
+# be given multiple times
+def getCmdLineArguments(longOpt,shortOpt="none"):
+	# Use global opts variable
+	vals = []
+	for opt,val in opts:
+		if (opt == shortOpt) or (opt == longOpt):
+			vals.append(val)
+
+	return vals
 
 def getDbName(dbFile):
 	answer = raw_input("Name for data base (default: "+dbFile+"): ")
@@ -1081,31 +2212,16 @@ def getFidsOfOid(oid):
 	if debug: print("getFidsOfOid:",oid)
 
 	if not isOid(oid):
-		print('Not a valid option id ('+str(oid)+')')
-		sys.exit(1)
-
-	sqlCurs.execute('SELECT fidString FROM options WHERE oid=?',(oid,))
-	row = sqlCurs.fetchone()
-
-	if (row[0] == None):
-		return []
-
-	fids = row[0].split(',')
-	try:
-		fids = map(int,fids)
-	except ValueError:
-		return []
+		raise SeriesError('Not a valid option id ('+str(oid)+')')
 
-	return fids
+	return list(getCatalog().options[oid].fids)
 
 # Returns fileName belonging to given fid
 def getFileName(fid):
 	if debug: print('getFileName: ',fid)
 	verifyFid(fid)
 
-	sqlCurs.execute('SELECT fileName FROM files WHERE fid=?',(fid,))
-	row = sqlCurs.fetchone()
-	return row[0]
+	return getCatalog().files[int(fid)].name
 
 # Returns list of fileNames
 def getFiles(includeFilesWithoutOption=False):
@@ -1114,8 +2230,8 @@ def getFiles(includeFilesWithoutOption=False):
 	allFiles = []
 
 	if includeFilesWithoutOption:
-		for row in sqlExecute('SELECT fileName FROM files'):
-			allFiles.append(row[0])
+		for f in getCatalog().files.values():
+			allFiles.append(f.name)
 
 	else:
 		allOpts = getOptions(['case','meta'])
@@ -1133,19 +2249,138 @@ def getFilesOfOption(optName):
 	oid = verifyOption(optName)
 
 	files = []
-	fids = getFidsOfOid(oid)
-	if (len(fids) == 1) and (fids[0] == ''):
-		return files
-
-	for fid in fids:
-		if not fid: continue
-		sqlCurs.execute('SELECT fileName FROM files WHERE fid=?',(fid,))
-		row = sqlCurs.fetchone()
-		if (type(row[0]) != None):
-			files.append(row[0])
+	catalogFiles = getCatalog().files
+	for fid in getFidsOfOid(oid):
+		if fid in catalogFiles:
+			files.append(catalogFiles[fid].name)
 
 	return files
 
+# Returns number of parallel jobs, by default the number of cores
+def getJobs():
+	if isCmdLineArgument('--jobs','-j'):
+		jobs = getCmdLineArgument('--jobs','-j')
+		try:
+			jobs = int(jobs)
+		except ValueError:
+			jobs = 0
+
+		if (jobs < 1):
+			raise SeriesError("Not a valid number of jobs ("+str(jobs)+")")
+
+		return jobs
+
+	try:
+		return multiprocessing.cpu_count()
+	except NotImplementedError:
+		return 1
+
+# Returns number of earlier case instances to keep per case (--keep)
+def getKeep():
+	if not isCmdLineArgument('--keep'):
+		return 0
+
+	keep = getCmdLineArgument('--keep')
+	if not keep.isdigit():
+		raise SeriesError("Not a valid number of case instances to keep ("+keep+")")
+
+	return int(keep)
+
+# Returns host and pid of process holding lock file, None if unknown
+def getLockOwner(lockFile):
+	try:
+		with open(lockFile,'r') as f:
+			host,pid = f.read().split()
+		return host,int(pid)
+	except (IOError,OSError,ValueError):
+		return None
+
+# Returns name of socket file of daemon serving given DB
+def getSocketFile(dbName):
+	dirName,baseName = os.path.split(dbName)
+	return os.path.join(dirName,"."+baseName+".sock")
+
+# Returns owner of lock of case and for how long it is held, for messages
+def getLockHolder(cid):
+	lockFile = getLockFile(cid)
+	owner = getLockOwner(lockFile) or ("?","?")
+	try:
+		age = int(time.time()-os.stat(lockFile).st_mtime)
+	except OSError:
+		age = 0
+
+	return str(owner[0])+":"+str(owner[1])+" since "+str(age)+" s"
+
+# Returns name of lock file of case, next to the case files
+def getLockFile(cid):
+	return "."+os.path.basename(dbFile)+"-"+getCaseName(cid)+".lock"
+
+# Returns what to do with cases locked by another process (--lock)
+def getLockPolicy():
+	if not isCmdLineArgument('--lock'):
+		return 'wait'
+
+	policy = getCmdLineArgument('--lock')
+	if policy not in lockPolicies:
+		raise SeriesError(
+			"Not a valid lock policy ("+policy+")\n"+
+			"Valid policies: "+", ".join(lockPolicies)
+			)
+
+	return policy
+
+# Returns how files without options are materialized in case trees
+def getLinkMode():
+	if not isCmdLineArgument('--link'):
+		return 'copy'
+
+	linkMode = getCmdLineArgument('--link')
+	if linkMode not in linkModes:
+		raise SeriesError(
+			"Not a valid link mode ("+linkMode+")\n"+
+			"Valid modes: "+", ".join(linkModes)
+			)
+
+	return linkMode
+
+# Returns pool of worker processes for jobs parallel jobs, the pool kept
+# by the daemon unless the number of jobs is given explicitly
+def getWorkerPool(jobs):
+	if (workerPool is not None) and not isCmdLineArgument('--jobs','-j'):
+		return workerPool
+
+	return multiprocessing.Pool(jobs,initWorker,(dbFile,))
+
+# Returns name of data base file in current directory, or None
+def findDbFile():
+	dbName = None
+	for f in os.listdir("./"):
+		if f.endswith(".db"):
+			dbName = f
+
+	return dbName
+
+# Returns offsets of option strings (OPT_) in file, at most limit ones.
+# The file is mapped to memory and searched as bytes
+def findOptionStrings(fileName,limit=None):
+	offsets = []
+	with open(fileName,'rb') as f:
+		size = os.fstat(f.fileno()).st_size
+		if (size == 0):
+			return offsets
+
+		mapped = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+		try:
+			pos = mapped.find(b"OPT_")
+			while (pos != -1) and (len(offsets) != limit):
+				offsets.append(pos)
+				pos = mapped.find(b"OPT_",pos+4)
+		finally:
+			mapped.close()
+
+	profileBytes(size)
+	return offsets
+
 # Returns list of cids with matching caseNames
 def getMatchingCids(caseName):
 	cids = []
@@ -1163,9 +2398,9 @@ def getMatchingCids(caseName):
 def getOptions(optTypes='any'):
 	verifyOptionType(optTypes)
 	opts = []
-	for optName,optType in sqlCurs.execute('SELECT optionName,optionType FROM options'):
-		if (optType in optTypes) or (optTypes == 'any'):
-			opts.append(optName)
+	for option in getCatalog().options.values():
+		if (option.type in optTypes) or (optTypes == 'any'):
+			opts.append(option.name)
 
 	return opts
 
@@ -1184,18 +2419,14 @@ def getOptionsUsedInFile(fileName):
 
 # Returns cid of first case of line
 def getPartriarchCid(cid):
-	while getFatherCid(cid):
-		cid = getFatherCid(cid)
-
-	return cid
+	return getAncestorCids(cid)[-1]
 
 # Returns name of run file and directory where it is located
 def getRunFileAndDir(cid,runFid):
 	if debug: print('getRunFileAndDir: ',cid,runFid)
 
 	if not runFid:
-		print("No run file defined")
-		sys.exit(1)
+		raise SeriesError("No run file defined")
 
 	# Get name of runfile and templateFid
 	runFileName = getFileName(runFid)
@@ -1217,18 +2448,31 @@ def getRunFileAndDir(cid,runFid):
 	# Return
 	return runFile,runDirectory
 
+# Returns maximum run time of a case in seconds, 0 if unlimited
+def getRunTimeout():
+	if not isCmdLineArgument('--timeout'):
+		return 0
+
+	timeout = getCmdLineArgument('--timeout')
+	if not isNumber(timeout) or (float(timeout) <= 0):
+		raise SeriesError("Not a valid timeout ("+timeout+")")
+
+	return float(timeout)
+
 # Returns cids of siblings
 def getSiblingsCid(cid):
 	if debug: print("getSiblingsCid: ",cid)
 	verifyCid(cid)
 
-	fatherCid = getFatherCid(cid)
-	if not fatherCid:
-		return []
+	siblings = []
+	for row in sqlCurs.execute('''
+			SELECT siblings.cid
+			FROM caseData
+			JOIN caseData AS siblings ON siblings.fatherCid=caseData.fatherCid
+			WHERE caseData.cid=? AND caseData.fatherCid!=0
+				AND siblings.cid!=caseData.cid''',(cid,)):
+		siblings.append(row[0])
 
-	siblings = getSonsCid(fatherCid)
-	idx = siblings.index(cid)
-	siblings.pop(idx)
 	return siblings
 
 # Returns cids of sons
@@ -1244,14 +2488,17 @@ def getSonsCid(cid):
 
 	return sons
 
+# Returns name of file caching parsed template files, next to given DB
+def getTemplateCacheFile(dbName):
+	dirName,baseName = os.path.split(dbName)
+	return os.path.join(dirName,"."+baseName+".templates")
+
 # Returns list of template files being directories
 def getTemplateDirs():
 	dirs = []
-	for row in sqlCurs.execute('''
-		SELECT fileName
-		FROM files
-		WHERE isDirectory='yes' '''):
-		dirs.append(row[0])
+	for f in getCatalog().files.values():
+		if f.isDirectory:
+			dirs.append(f.name)
 
 	return dirs
 
@@ -1262,12 +2509,7 @@ def getTemplateFid(fileName):
 	# File is already known, just read template fid from DB
 	fid = isFile(fileName)
 	if fid:
-		sqlCurs.execute('''
-			SELECT templateFid
-			FROM files
-			WHERE fid=?''',(fid,))
-		row = sqlCurs.fetchone()
-		return row[0]
+		return getCatalog().files[fid].templateFid
 
 	# File is not known to DB, find out tmplDir
 	else:
@@ -1279,9 +2521,8 @@ def getTemplateFid(fileName):
 
 		l = len(foundIn)
 		if (l == 0):
-			print("File not contained in template directories ("+fileName+")")
 			delFile(fileName,True)
-			sys.exit(1)
+			raise SeriesError("File not contained in template directories ("+fileName+")")
 
 		elif (l > 1):
 			print("Warning: Found file multiple times!")
@@ -1292,6 +2533,88 @@ def getTemplateFid(fileName):
 			tDirFid = isFile(tDir)
 			return tDirFid
 
+# Returns cached entry of template file with its size, time of last
+# modification, SHA1 digest and whether it contains option strings.
+# The entry is kept if size and time are unchanged, or else the digest
+# is. Times shortly before the entry was checked are not trusted, the
+# file might have changed within their resolution, which is whole
+# seconds on some file systems. Callers checking many files save the
+# cache once at the end instead
+def getTemplateEntry(path,save=True):
+	cache = loadTemplateCache()
+	path = os.path.normpath(path)
+	stat = os.stat(path)
+
+	resolution = 0.1
+	if (stat.st_mtime == int(stat.st_mtime)):
+		resolution = 2
+
+	entry = cache['files'].get(path)
+	if entry and (entry['size'] == stat.st_size) \
+		and (entry['mtime'] == stat.st_mtime) \
+		and (stat.st_mtime < entry['checked']-resolution):
+		return entry
+
+	digest = hashlib.sha1()
+	hashFile(digest,path)
+	digest = digest.hexdigest()
+
+	changed = (entry is None) or (entry['sha1'] != digest) \
+		or (entry['size'] != stat.st_size) or (entry['mtime'] != stat.st_mtime)
+	if (entry is None) or (entry['sha1'] != digest):
+		entry = {
+			'sha1': digest,
+			'optionStrings': len(findOptionStrings(path,1)) > 0,
+			'tokens': None,
+			'matches': [],
+			}
+
+	entry['size'] = stat.st_size
+	entry['mtime'] = stat.st_mtime
+	entry['checked'] = time.time()
+	cache['files'][path] = entry
+
+	# Written unless only checked again, or from now on trusted
+	if changed or (stat.st_mtime < entry['checked']-resolution):
+		if save:
+			saveTemplateCache()
+		else:
+			cache['unsaved'] = True
+
+	return entry
+
+# Returns list of offsets and option strings of template file matched by
+# pattern, see compileOptionsOfCid. The file is scanned only if it was
+# changed or the option strings differ from the cached ones
+def getTemplateMatches(path,pattern,tokens):
+	entry = getTemplateEntry(path)
+	if not entry['optionStrings']:
+		return []
+
+	key = ",".join(sorted(tokens))
+	if (entry['tokens'] != key):
+		with open(path,'rb') as source:
+			entry['matches'] = scanOptionStrings(pattern,tokens,source)
+		entry['tokens'] = key
+		saveTemplateCache()
+
+	return entry['matches']
+
+# Returns path of file within the templates, i.e. the file name not
+# yet adapted to a case
+def getTemplatePath(fileName):
+	# Find out template fid
+	fid = verifyFile(fileName)
+	tmplFid = getCatalog().files[fid].templateFid
+
+	# If file is a template file it is already fully qualified
+	if (tmplFid == 0):
+		return fileName
+
+	# Prepend template directory to fileName
+	tmplDirName = getFileName(tmplFid)
+	return tmplDirName + "/" + fileName
+
 # Returns name of corresponding template file
 def getTemplateName(fileName):
 	if debug: print('getTemplateName: ',fileName)
@@ -1332,13 +2655,41 @@ def getValueOfOption(optName):
 	oid = verifyOption(optName)
 
 	if isOption(optName,'meta'):
-		print("Cannot handle meta options. Call getValueOfMetaOptionOf... instead.")
-		sys.exit(1)
+		raise SeriesError("Cannot handle meta options. Call getValueOfMetaOptionOf... instead.")
 
 	else:
-		sqlCurs.execute('SELECT defaultValue FROM options WHERE oid=?',(oid,))
-		row = sqlCurs.fetchone()
-		return row[0]
+		return getCatalog().options[oid].default
+
+# Returns dict of values of given options for specific cid, resolving
+# case values, defaults and meta options at once
+def getValuesOfOptionsOfCid(cid,optNames):
+	if debug: print("getValuesOfOptionsOfCid:",cid,optNames)
+	cid = verifyCid(cid)
+
+	# Default values, replaced by values set for cid
+	options = getCatalog().options
+	values = {}
+	for option in options.values():
+		if (option.type != 'meta'):
+			values[option.name.lower()] = option.default
+
+	for oid,value in sqlCurs.execute(
+			'SELECT oid,value FROM caseOptions WHERE cid=?',(cid,)):
+		if (oid in options) and (options[oid].type != 'meta') \
+			and (value is not None):
+			values[options[oid].name.lower()] = value
+
+	# Keep the spelling of the names asked for
+	resolved = {}
+	for opt in optNames:
+		if opt in metaOptions:
+			resolved[opt] = getValueOfMetaOptionOfCid(opt,cid)
+		elif opt.lower() in values:
+			resolved[opt] = values[opt.lower()]
+		else:
+			verifyOption(opt)
+
+	return resolved
 
 # Returns value of given option for specific case
 def getValueOfOptionOfCase(optionName,caseName):
@@ -1351,18 +2702,14 @@ def getValueOfOptionOfCid(optionName,cid):
 	oid = isOption(optionName)
 	
 	# Look at first if option has non-default value for case
-	sqlCurs.execute('SELECT oidString,valueString FROM caseData WHERE cid=?',(cid,))
+	sqlCurs.execute('''
+		SELECT value
+		FROM caseOptions
+		WHERE cid=? AND oid=?''',(cid,oid))
 	row = sqlCurs.fetchone()
 
-	if (row[0] != None) and (len(row[0]) > 0):
-		caseOids = row[0].split(',')
-		caseOids = map(int,caseOids)
-		caseVals = row[1].split(',')
-		caseVals = [ v.replace("_;_",",") for v in caseVals ]
-		
-		if oid in caseOids:
-			idx = caseOids.index(oid)
-			return caseVals[idx]
+	if row:
+		return row[0]
 
 	# Option not set for this case, return default value
 	if optionName in metaOptions:
@@ -1370,15 +2717,30 @@ def getValueOfOptionOfCid(optionName,cid):
 	else:
 		return getValueOfOption(optionName)
 
+# Returns conditions given by --where, see parseWhere
+def getWhere():
+	return [ parseWhere(w) for w in getCmdLineArguments('--where') ]
+
 # Returns a cid of a youngest (leaf)
 def getYoungCid(cid):
 	verifyCid(cid)
 
-	sonsCid = getSonsCid(cid)
-	if (len(sonsCid) != 0):
-		return getYoungCid(sonsCid[0])
-	else:
-		return cid
+	# Follows the first son of each generation, see getAncestorCids for
+	# the recursive query
+	sqlCurs.execute('''
+		SELECT cid FROM (
+			WITH RECURSIVE line(cid,depth) AS (
+				SELECT ?,0
+				UNION ALL
+				SELECT (SELECT MIN(cid) FROM caseData WHERE fatherCid=line.cid),
+					line.depth+1
+				FROM line
+				WHERE EXISTS (SELECT 1 FROM caseData WHERE fatherCid=line.cid)
+					AND line.depth<(SELECT COUNT(*) FROM caseData))
+			SELECT cid,depth FROM line)
+		ORDER BY depth DESC LIMIT 1''',(cid,))
+
+	return sqlCurs.fetchone()[0]
 
 # Takes caseName and processes it according to command line arguments,
 # might result in execution of multiple cases
@@ -1394,17 +2756,25 @@ def handleCmdCase(caseName):
 	else:
 		cid = isCase(caseName)
 		
+		# Case with exact case name exists, but does not match --where
+		if (cid != 0) and isCmdLineArgument('--where') \
+			and not getCidsWhere(getWhere(),caseName,True):
+			raise SeriesError("Case does not match --where ("+caseName+")")
+
 		# Case with exact case name exists
-		if (cid != 0):
+		elif (cid != 0):
 			handleCidSingle(cid)
 		
-		# Look for cases containing caseName as substring
+		# Look for cases containing caseName as substring, and matching
+		# --where if given
 		else:
-			cids = getMatchingCids(caseName)
+			if isCmdLineArgument('--where'):
+				cids = getCidsWhere(getWhere(),caseName)
+			else:
+				cids = getMatchingCids(caseName)
 			
 			if (len(cids) == 0):
-				print("No matching case ("+caseName+")")
-				sys.exit(1)
+				raise SeriesError("No matching case ("+caseName+")")
 			
 			elif (len(cids) == 1):
 				print("Did not find "+caseName+", taking "+getCaseName(cids[0]))
@@ -1496,8 +2866,16 @@ def handleCidSingle(cid):
 	# Print case
 	elif isCmdLineArgument('--print','-p'):
 		
+		# History of case
+		if isCmdLineArgument('--history'):
+			printCidHistory(cid)
+
+		# Ancestors, siblings and descendants of case
+		elif isCmdLineArgument('--lineage'):
+			printCidLineage(cid)
+
 		# Case including default options
-		if isCmdLineArgument('--default'):
+		elif isCmdLineArgument('--default'):
 			printCidOptions(cid,True)
 
 		# Case with only non-default options
@@ -1515,16 +2893,40 @@ def handleCidSingle(cid):
 
 # Process all given cids according to command line arguments
 def handleCidMulti(cids):
-	print("Found multiple ("+str(len(cids))+") matching cases:")
-	for cid in cids:
-		caseName = getCaseName(cid)
-		print("  "+caseName)
-	
-	answer = raw_input("Proceed? (Y/n): ")
-	if (answer != 'Y'):
-		print("Abort.")
-		sys.exit(0)
-	
+	# Ask unless confirmed on the command line, printing changes nothing
+	if not isCmdLineArgument('--yes','-y') \
+		and not isCmdLineArgument('--print','-p'):
+		print("Found multiple ("+str(len(cids))+") matching cases:")
+		for cid in cids:
+			caseName = getCaseName(cid)
+			print("  "+caseName)
+
+		answer = raw_input("Proceed? (Y/n): ")
+		if (answer != 'Y'):
+			print("Abort.")
+			sys.exit(0)
+
+	# Builds and runs are independent of each other, run them in parallel
+	if isCmdLineArgument('--build','-b') \
+		and not isCmdLineArgument('--add','-a'):
+		buildCids(cids)
+		return
+
+	if isCmdLineArgument('--run','-r') \
+		and not isCmdLineArgument('--add','-a'):
+		runCids(cids)
+		return
+
+	# Set option of all cases at once
+	if isCmdLineArgument('--modify','-m') \
+		and isCmdLineArgument('--option','-O') \
+		and isCmdLineArgument('--value','-V'):
+		values = {
+			getCmdLineArgument('--option','-O'): getCmdLineArgument('--value','-V')
+			}
+		modOptionValuesOfCids([ (cid,values) for cid in cids ])
+		return
+
 	for cid in cids:
 		caseName = getCaseName(cid)
 		print("Processing "+caseName)
@@ -1537,9 +2939,10 @@ def handleTreeBuildingForExistingCase(cid,caseFile,buildFile):
 		return
 
 	if not os.path.isfile(buildFile):
-		print("Not a valid build file ("+buildFile+")")
-		print("Delete case manually.")
-		sys.exit(1)
+		raise SeriesError(
+			"Not a valid build file ("+buildFile+")\n"+
+			"Delete case manually."
+			)
 
 	auto = isCmdLineArgument('--auto')
 	force = isCmdLineArgument('--force','-f')
@@ -1547,13 +2950,8 @@ def handleTreeBuildingForExistingCase(cid,caseFile,buildFile):
 	buildCid = getBuildCid(buildFile)
 	caseName = getCaseName(cid)
 
-	# Automatic mode, decide based on buildCid and cid if case needs
-	# to be rebuild, or can be leaved just like it is
+	# Automatic mode, buildCid found case to be outdated, rebuild
 	if auto:
-		if (buildCid == cid):
-			print(caseName+' already up to date.')
-			sys.exit(0)
-
 		force = True
 
 	# Standard, print info and ask if case is really to delete
@@ -1565,14 +2963,128 @@ def handleTreeBuildingForExistingCase(cid,caseFile,buildFile):
 	# Go ahead and delete
 	delBuildCase(cid,force)
 
+# Adds content of file to digest
+def hashFile(digest,fileName):
+	with open(fileName,'rb') as f:
+		while True:
+			block = f.read(chunkSize)
+			if not block: break
+			digest.update(block)
+			profileBytes(len(block))
+	digest.update(b"\0")
+
+# Imports series from file written by export, JSON files restore the
+# complete series into an empty one, CSV files add cases
+def importSeries(fileName):
+	if debug: print('importSeries',fileName)
+
+	if not os.path.isfile(fileName):
+		raise SeriesError("Not a valid file ("+fileName+")")
+
+	if not fileName.lower().endswith('.json'):
+		rows = readCaseTable(fileName,True)
+		cids = addCases([ (r.pop('caseName'),r) for r in rows ])
+		print("Added "+str(len(cids))+" cases")
+		return
+
+	with open(fileName,'r') as f:
+		data = json.load(f)
+
+	if not isinstance(data,dict) or (data.get('format') != 1):
+		raise SeriesError("Not a valid export file ("+fileName+")")
+
+	# Only an empty series can be restored
+	sqlCurs.execute('''
+		SELECT
+			(SELECT COUNT(*) FROM cases)+
+			(SELECT COUNT(*) FROM files)+
+			(SELECT COUNT(*) FROM options WHERE optionType!='series')''')
+	if sqlCurs.fetchone()[0]:
+		raise SeriesError("Import requires an empty series, create one with --createDB")
+
+	# Options replace the series options of the empty series, except the
+	# ones identifying it, e.g. its name used for the case directories
+	marks = ",".join("?"*len(identityOptions))
+	identity = dict(sqlCurs.execute('''
+		SELECT optionName,defaultValue
+		FROM options
+		WHERE optionName IN ('''+marks+')',identityOptions).fetchall())
+
+	sqlCurs.execute('DELETE FROM options')
+	oids = {}
+	for o in data['options']:
+		insert = (
+			o['oid'],o['optionName'],
+			identity.get(o['optionName'],o['defaultValue']),
+			",".join(str(f) for f in o['fids']),o['optionType'],o['comment'],
+			)
+		sqlCurs.execute('''
+			INSERT INTO options
+			(oid,optionName,defaultValue,fidString,optionType,comment)
+			VALUES (?,?,?,?,?,?)''',insert)
+		oids[o['optionName']] = o['oid']
+
+	sqlCurs.executemany('''
+		INSERT INTO files (fid,fileName,templateFid,isDirectory)
+		VALUES (?,?,?,?)''',
+		[ (f['fid'],f['fileName'],f['templateFid'],f['isDirectory'])
+			for f in data['files'] ])
+	clearCatalog()
+
+	caseData = data['caseData']
+	for i,c in enumerate(caseData):
+		insert = (
+			c['cid'],c['fatherCid'],c['timeCreated'],
+			c['timeBuild'],c['builds'],c['comment'],
+			)
+		sqlCurs.execute('''
+			INSERT INTO caseData
+			(cid,fatherCid,timeCreated,timeBuild,builds,comment)
+			VALUES (?,?,?,?,?,?)''',insert)
+
+		sqlCurs.executemany('''
+			INSERT INTO caseOptions (cid,oid,value)
+			VALUES (?,?,?)''',
+			[ (c['cid'],oids[o],v) for o,v in c['options'].items() ])
+
+		if (i % 1000 == 0) or (i+1 == len(caseData)):
+			printProgress("Importing cases",i+1,len(caseData))
+
+	sqlCurs.executemany('''
+		INSERT INTO cases (caseName,currentCid,comment)
+		VALUES (?,?,?)''',
+		[ (c['caseName'],c['currentCid'],c['comment']) for c in data['cases'] ])
+
+	print("Imported "+str(len(data['cases']))+" cases")
+
+# Returns true if all case files of cid exist and were built with
+# given fingerprint
+def isBuildUpToDate(cid,fingerprint):
+	for tFile in getFilesOfOption('templateFiles'):
+		cFile = buildFQFN(cid,tFile)
+		bFile = getBuildFile(cFile,tFile)
+
+		if not os.path.exists(cFile) or not os.path.isfile(bFile):
+			return False
+
+		if (getBuildFingerprint(bFile) != fingerprint):
+			return False
+
+	return True
+
 # Returns case id if given argument is valid case, 0 otherwise
 def isCase(caseName):
 	if (len(str(caseName)) == 0):
 		return 0
 
-	for c in sqlCurs.execute('SELECT caseName,currentCid FROM cases'):
-		if caseName.lower() == c[0].lower():
-			return c[1]
+	sqlCurs.execute('''
+		SELECT currentCid
+		FROM cases
+		WHERE caseName=? COLLATE NOCASE''',(caseName,))
+	row = sqlCurs.fetchone()
+
+	if row:
+		return row[0]
 
 	return 0
 
@@ -1581,13 +3093,12 @@ def isCid(i,hasToBeCurrentCid=False):
 	i = int(i)
 
 	if hasToBeCurrentCid:
-		for row in sqlCurs.execute('SELECT currentCid FROM cases'):
-			if (i == row[0]):
-				return True
+		sqlCurs.execute('SELECT 1 FROM cases WHERE currentCid=?',(i,))
 	else:
-		for row in sqlCurs.execute('SELECT cid FROM caseData'):
-			if (i == row[0]):
-				return True
+		sqlCurs.execute('SELECT 1 FROM caseData WHERE cid=?',(i,))
+
+	if sqlCurs.fetchone():
+		return True
 
 	return False
 
@@ -1600,6 +3111,18 @@ def isCmdLineArgument(longOpt,shortOpt="none"):
 
 	return False
 
+# Connects worker process to DB, the connection of the parent is not
+# to be shared
+def initWorker(dbName):
+	global sqlCurs,inWorker
+
+	# Workers of pools created by the daemon are stopped by SIGTERM
+	signal.signal(signal.SIGTERM,signal.SIG_DFL)
+
+	sqlCon = connectDB(dbName)
+	sqlCurs = sqlCon.cursor()
+	inWorker = True
+
 # Connect to DB
 def isDB(dbFile,create=False):
 	if os.path.isfile(dbFile):
@@ -1626,30 +3149,33 @@ def isDefaultValue(optName,value):
 # Returns true if file is a directory
 def isDirectory(fileName):
 	fid = verifyFile(fileName)
-	sqlCurs.execute('SELECT isDirectory FROM files WHERE fid=?',(fid,))
-	row = sqlCurs.fetchone()
-
-	if (row[0] == 'yes'):
-		return True
-	else:
-		return False
+	return getCatalog().files[fid].isDirectory
 
 # Returns true if given argument is valid file id
 def isFid(i):
-	for ret in sqlCurs.execute('SELECT fid FROM files'):
-		if (i == ret[0]):
-			return 1
+	if i in getCatalog().files:
+		return 1
 
 	return 0
 
 # Returns file id if file exists, 0 otherwise
 def isFile(f):
-	for entry in sqlCurs.execute('SELECT fid,fileName FROM files'):
-		if (f.lower() == entry[1].lower()):
-			return entry[0]
+	record = getCatalog().file(f)
+
+	if record:
+		return record.fid
 
 	return 0
 
+# Returns true if process with given pid is running on this host
+def isProcessAlive(pid):
+	try:
+		os.kill(pid,0)
+	except OSError as e:
+		return (e.errno == errno.EPERM)
+
+	return True
+
 # Returns true if string can be cast as float
 def isNumber(s):
 	try:
@@ -1661,22 +3187,20 @@ def isNumber(s):
 # Returns true if given argument is valid option id
 def isOid(i,optType='any'):
 	verifyOptionType(optType)
+	option = getCatalog().options.get(i)
 
-	for row in sqlCurs.execute('SELECT oid,optionType FROM options'):
-		if ((row[1] == optType) or (optType == 'any')) and \
-			(i == row[0]):
-			return 1
+	if option and ((option.type == optType) or (optType == 'any')):
+		return 1
 
 	return 0
 
 # Returns option id if given argument is valid option, 0 otherwise
 def isOption(optName,optType='any'):
 	verifyOptionType(optType)
+	option = getCatalog().option(optName)
 
-	for row in sqlCurs.execute('SELECT oid,optionName,optionType FROM options'):
-		if ((row[2] == optType) or (optType == 'any')) and \
-			(optName.lower() == row[1].lower()):
-			return row[0]
+	if option and ((option.type == optType) or (optType == 'any')):
+		return option.oid
 
 	return 0
 
@@ -1691,17 +3215,14 @@ def isOptionSetForCid(optName,cid):
 	verifyCid(cid)
 	oid = verifyOption(optName)
 
-	# Get current option and value string from case
-	sqlCurs.execute('SELECT oidString FROM caseData WHERE cid=?',(cid,))
-	row = sqlCurs.fetchone()
-
 	# See if option is set
-	if (row[0] != None) and (len(row[0]) > 0):
-		caseOids = row[0].split(',')
-		caseOids = map(int,caseOids)
+	sqlCurs.execute('''
+		SELECT 1
+		FROM caseOptions
+		WHERE cid=? AND oid=?''',(cid,oid))
 
-		if oid in caseOids:
-			return True
+	if sqlCurs.fetchone():
+		return True
 
 	return False
 
@@ -1711,25 +3232,243 @@ def isOptionUsedInFile(optName,fileName):
 	oid = verifyOption(optName)
 	fid = verifyFile(fileName)
 
-	sqlCurs.execute('SELECT fidString FROM options WHERE oid=?',(oid,))
-	row = sqlCurs.fetchone()
-	fidString = row[0]
-	fids = []
+	return fid in getCatalog().options[oid].fids
 
-	if (fidString != None):
-		fids = fidString.split(',')
-		fids = map(int,fids)
+# Yields name, cid and list of pairs of option name and value of all
+# cases ordered by name, running a single query. Only options set for
+# the cases are included
+def iterCasesWithOptions():
+	curs = getCursor()
+	rows = curs.execute('''
+		SELECT caseName,currentCid,optionName,value
+		FROM cases
+		LEFT JOIN caseOptions ON caseOptions.cid=cases.currentCid
+		LEFT JOIN options
+			ON options.oid=caseOptions.oid AND options.optionType!='series'
+		ORDER BY caseName,optionName''')
+
+	for caseName,group in itertools.groupby(rows,lambda r: r[0]):
+		group = list(group)
+		opts = [ (r[2],r[3]) for r in group if r[2] is not None ]
+		yield caseName,group[0][1],opts
+
+# Yields name of each case with list of pairs of option name and value,
+# ordered by option name. Only options set for the case are included,
+# unless showDefaults is True
+def iterCaseOptionValues(showDefaults=False):
+	if not showDefaults:
+		for caseName,cid,options in iterCasesWithOptions():
+			yield caseName,options
+		return
 
-	if fid in fids:
+	optNames = []
+	defaults = {}
+	for optName,value in sqlCurs.execute('''
+			SELECT optionName,defaultValue
+			FROM options
+			WHERE optionType!='series'
+			ORDER BY optionName'''):
+		optNames.append(optName)
+		defaults[optName] = value
+
+	# Values of meta options, as getValueOfMetaOptionOfCid returns them
+	defaults['_seriesName'] = getValueOfOption('seriesName')
+
+	for caseName,cid,options in iterCasesWithOptions():
+		values = dict(defaults)
+		values.update(options)
+		values['_caseName'] = caseName
+
+		yield caseName,[ (o,values[o]) for o in optNames ]
+
+# Terminates a run file process and all its children
+def killRun(process,sig):
+	try:
+		os.killpg(process.pid,sig)
+	except OSError:
+		pass
+
+# Locks case for this process by creating its lock file, which only
+# succeeds for one process, also on NFS. Returns False if the case is
+# locked by another process. Locks of processes that ended on this
+# host are removed. Locks are held recursively within a process
+def lockCase(cid):
+	lockFile = getLockFile(cid)
+	if lockFile in heldLocks:
+		heldLocks[lockFile] += 1
 		return True
-	else:
-		return False
+
+	host = socket.gethostname()
+	while True:
+		try:
+			fd = os.open(lockFile,os.O_CREAT|os.O_EXCL|os.O_WRONLY,0o644)
+		except OSError as e:
+			if (e.errno != errno.EEXIST):
+				raise
+
+			if not breakStaleLock(lockFile):
+				return False
+			continue
+
+		os.write(fd,toBytes(host+" "+str(os.getpid())+"\n"))
+		os.close(fd)
+		heldLocks[lockFile] = 1
+		return True
+
+# Locks case for the time within according to --lock, yields False if
+# the case is to be skipped since it is locked by another process.
+# While waiting, the owner and age of the lock are printed every minute
+@contextlib.contextmanager
+def lockedCase(cid):
+	policy = getLockPolicy()
+
+	printed = 0
+	while not lockCase(cid):
+		if (policy == 'skip'):
+			print(getCaseName(cid)+": locked by "+getLockHolder(cid)+", skipped")
+			yield False
+			return
+
+		if (time.time()-printed > 60):
+			print(getCaseName(cid)+": waiting for lock held by "+getLockHolder(cid))
+			printed = time.time()
+		time.sleep(0.2)
+
+	try:
+		yield True
+	finally:
+		unlockCase(cid)
+
+# Returns paths of all files of template file or directory, sorted.
+# Symlinks in template directories are followed
+def listTemplateFiles(tFile):
+	if not os.path.isdir(tFile):
+		return [ os.path.normpath(tFile) ]
+
+	paths = []
+	for root,dirs,files in os.walk(tFile,followlinks=True):
+		dirs.sort()
+		for f in sorted(files):
+			paths.append(os.path.normpath(os.path.join(root,f)))
+
+	return paths
+
+# Creates case file from template file according to link mode, falls
+# back to copying if the link cannot be created
+def materializeFile(tFile,cFile,linkMode='copy'):
+	source = os.path.realpath(tFile)
+
+	try:
+		if (linkMode == 'reflink'):
+			reflinkFile(source,cFile)
+			shutil.copymode(source,cFile)
+			return
+
+		if (linkMode == 'hardlink'):
+			os.link(source,cFile)
+			return
+
+		if (linkMode == 'symlink'):
+			os.symlink(source,cFile)
+			return
+
+	except (IOError,OSError):
+		if os.path.lexists(cFile):
+			os.remove(cFile)
+
+	shutil.copy2(tFile,cFile)
+	profileCopy(tFile)
+
+# Returns cache of parsed template files of the data base, read from its
+# file next to the data base when first used
+def loadTemplateCache():
+	global templateCache
+	cacheFile = getTemplateCacheFile(dbFile)
+	if (templateCache is not None) and (templateCache['file'] == cacheFile):
+		return templateCache
+
+	templateCache = {
+		'file': cacheFile,
+		'files': readTemplateCache(cacheFile),
+		'unsaved': False,
+		}
+	return templateCache
+
+# Creates case directory from template directory, files contained in
+# copyPaths are copied, all others are materialized according to link
+# mode. Symlinks in the template are followed
+def materializeTree(tDir,cDir,copyPaths,linkMode='copy'):
+	createdDirs = []
+	for root,dirs,files in os.walk(tDir,followlinks=True):
+		target = os.path.join(cDir,os.path.relpath(root,tDir))
+		os.makedirs(target)
+		createdDirs.append((root,target))
+
+		for f in files:
+			tFile = os.path.join(root,f)
+			cFile = os.path.join(target,f)
+			if os.path.normpath(tFile) in copyPaths:
+				shutil.copy2(tFile,cFile)
+				profileCopy(tFile)
+			else:
+				materializeFile(tFile,cFile,linkMode)
+
+	# Permissions of directories last, they might be read-only
+	for root,target in reversed(createdDirs):
+		shutil.copystat(root,target)
+
+# Adds profile reported by a worker to the profile of the command
+def mergeProfile(report):
+	if (profile is not None) and (report is not None):
+		profile.merge(report)
+
+# Brings a data base created by an earlier version up to date
+def migrateDB():
+	with profilePhase('lookup'):
+		sqlCurs.execute('PRAGMA user_version')
+		version = sqlCurs.fetchone()[0]
+
+	if (version >= dbVersion):
+		return
+
+	# Version 1: Indexes on names and father cids
+	if (version < 1):
+		try:
+			createIndexes()
+		except sqlite3.IntegrityError:
+			raise SeriesError("Cannot migrate database, names are not unique (ignoring case)")
+
+	# Version 2: Options of cases in table caseOptions instead of
+	# comma seperated oidString and valueString of caseData. Python 2
+	# commits the table before the rows are converted, so the step is
+	# to be repeated if the conversion did not finish
+	if (version < 2):
+		createCaseOptionsTable()
+
+		inserts = []
+		for cid,oidString,valString in sqlCurs.execute('''
+				SELECT cid,oidString,valueString
+				FROM caseData
+				WHERE LENGTH(oidString)>0'''):
+			oids = [ int(o) for o in oidString.split(',') ]
+			vals = [ v.replace("_;_",",") for v in valString.split(',') ]
+			for oid,val in zip(oids,vals):
+				inserts.append((cid,oid,val))
+
+		sqlCurs.executemany('''
+			INSERT OR REPLACE INTO caseOptions (cid,oid,value)
+			VALUES (?,?,?)''',inserts)
+		sqlCurs.execute('''
+			UPDATE caseData
+			SET oidString=NULL,valueString=NULL''')
+
+	sqlCurs.execute('PRAGMA user_version=%d' % dbVersion)
+	sqlCurs.connection.commit()
 
 # Changes the name of cid
 def modNameOfCid(cid,newName):
 	if (isCase(newName) > 0):
-		print("Name already in use ("+newName+")")
-		sys.exit(1)
+		raise SeriesError("Name already in use ("+newName+")")
 	
 	insert = (newName,cid)
 	sqlCurs.execute('UPDATE cases SET caseName=? WHERE currentCid=?',insert)
@@ -1740,18 +3479,17 @@ def modOptionName(optName,newName):
 	oid = verifyOption(optName)
 
 	if (len(newName) == 0):
-		print("Expected option name")
-		sys.exit(1)
+		raise SeriesError("Expected option name")
 
 	if isOption(newName):
-		print("Option "+newName+" already exists")
-		sys.exit(1)
+		raise SeriesError("Option "+newName+" already exists")
 
 	insert = (newName,oid)
 	sqlCurs.execute('''
 		UPDATE options
 		SET optionName=?
 		WHERE oid=?''',insert)
+	clearCatalog()
 
 # Changes default value of option
 def modOptionValue(optName,optValNew):
@@ -1759,22 +3497,35 @@ def modOptionValue(optName,optValNew):
 	oid = verifyOption(optName)
 	optValOld = getValueOfOption(optName)
 
-	# Get all cids
-	allCids = []
-	for row in sqlCurs.execute('SELECT cid FROM caseData'):
-		allCids.append(row[0])
-
 	# Set old value as option for all cases using the default value,
 	# do not create new instances for that since nothing changed for
-	# those cases
+	# those cases. Cids having the option set are left as they are.
+	# Done in chunks of cids, all within the same transaction
 	if not isOption(optName,'series'):
-		for cid in allCids:
-			if not isOptionSetForCid(optName,cid):
-				addOptionToCid(optName,optValOld,cid,False)
+		sqlCurs.execute('SELECT MIN(cid),MAX(cid) FROM caseData')
+		minCid,maxCid = sqlCurs.fetchone()
+		chunk = 10000
+
+		if minCid is not None:
+			pinned = 0
+			for first in range(minCid,maxCid+1,chunk):
+				insert = (oid,optValOld,first,first+chunk-1)
+				sqlCurs.execute('''
+					INSERT OR IGNORE INTO caseOptions (cid,oid,value)
+					SELECT cid,?,?
+					FROM caseData
+					WHERE cid BETWEEN ? AND ?''',insert)
+				pinned += sqlCurs.rowcount
+
+				done = min(first+chunk,maxCid+1)-minCid
+				printProgress("Keeping old value",done,maxCid+1-minCid)
+
+			print("Kept old value "+str(optValOld)+" for "+str(pinned)+" case ids")
 
 	# Update value in DB
 	insert = (optValNew,oid)
 	sqlCurs.execute('UPDATE options SET defaultValue=? WHERE oid=?',insert)
+	clearCatalog()
 
 # Changes value of option for given case
 def modOptionValueOfCase(caseName,optName,optValue):
@@ -1793,28 +3544,108 @@ def modOptionValueOfCid(cid,optName,optValue):
 
 	cid = verifyCid(cid)
 	oid = verifyOption(optName)
-	
-	# Get current option and value string from case
-	sqlCurs.execute('SELECT oidString,valueString FROM caseData WHERE cid=?',(cid,))
-	row = sqlCurs.fetchone()
-	oids = row[0].split(',')
-	oids = map(int,oids)
-	vals = row[1].split(',')
-	vals = [ v.replace("_;_",",") for v in vals ]
-
-	# Modify option
-	idx = oids.index(oid)
-	vals[idx] = optValue
-
-	# Build strings and update DB
-	oidString = ",".join(str(o) for o in oids)
-	valString = ",".join(str(v).replace(",","_;_") for v in vals)
 
 	# Update DB
 	newCid = addCaseData(cid)
+	copyOptionsOfCid(cid,newCid)
 	updateCurrentCid(cid,newCid)
-	insert = (oidString,valString,newCid)
-	sqlCurs.execute('UPDATE caseData SET oidString=?,valueString=? WHERE cid=?',insert)
+
+	insert = (str(optValue),newCid,oid)
+	sqlCurs.execute('''
+		UPDATE caseOptions
+		SET value=?
+		WHERE cid=? AND oid=?''',insert)
+
+# Sets values of options for many cids, given as list of pairs of cid
+# and dict of option values. Unless addInstance is False, one new case
+# instance holding all changes is added per cid
+def modOptionValuesOfCids(changes,addInstance=True):
+	if debug: print("modOptionValuesOfCids: ",len(changes))
+
+	# Look up options once
+	oids = {}
+	for cid,values in changes:
+		for optName in values:
+			if optName not in oids:
+				oids[optName] = verifyOption(optName,'case')
+
+	newCids = []
+	for i,(cid,values) in enumerate(changes):
+		cid = verifyCid(cid)
+
+		if addInstance:
+			newCid = addCaseData(cid)
+			copyOptionsOfCid(cid,newCid)
+			updateCurrentCid(cid,newCid)
+			cid = newCid
+		newCids.append(cid)
+
+		inserts = [ (cid,oids[o],toText(v)) for o,v in values.items() ]
+		sqlCurs.executemany('''
+			INSERT OR REPLACE INTO caseOptions (cid,oid,value)
+			VALUES (?,?,?)''',inserts)
+
+		if (i % 1000 == 0) or (i+1 == len(changes)):
+			printProgress("Modifying cases",i+1,len(changes))
+
+	return newCids
+
+# Returns name and list of values of option sweep given as
+# name=value1,value2,... or name=start:stop[:step], including stop
+def parseSweep(spec):
+	if (spec.find('=') == -1):
+		raise SeriesError("Not a valid sweep ("+spec+"), expected name=values")
+
+	optName,values = spec.split('=',1)
+
+	# List of values
+	if (values.find(':') == -1):
+		return optName,values.split(',')
+
+	# Range of values
+	bounds = values.split(':')
+	if (len(bounds) not in (2,3)) or not all(isNumber(b) for b in bounds):
+		raise SeriesError("Not a valid range ("+values+"), expected start:stop[:step]")
+
+	if (len(bounds) == 2):
+		bounds.append('1')
+
+	# Integers stay integers, otherwise format floats compactly
+	isInt = all(b.lstrip('-').isdigit() for b in bounds)
+	start,stop,step = [ float(b) for b in bounds ]
+	if (step == 0) or ((stop-start)/step < 0):
+		raise SeriesError("Not a valid range ("+values+")")
+
+	count = int(round((stop-start)/step,9)) + 1
+	points = [ start+i*step for i in range(count) ]
+	if isInt:
+		return optName,[ str(int(p)) for p in points ]
+	else:
+		return optName,[ '%.12g' % p for p in points ]
+
+# Returns option name, SQL operator and values of condition given as
+# name=value, name=value1,value2,..., name=start:stop or name<value
+# (also <=, >, >=). Conditions with = are negated by using != instead
+def parseWhere(spec):
+	match = re.match(r'^\s*([^=!<>\s]+)\s*(!=|<=|>=|=|<|>)\s*(.*?)\s*$',spec)
+	if not match:
+		raise SeriesError("Not a valid condition ("+spec+"), expected name=value")
+
+	optName,op,values = match.groups()
+
+	# Numeric comparison
+	if op in ('<','<=','>','>='):
+		if toNumber(values) is None:
+			raise SeriesError("Not a valid number ("+values+")")
+		return optName,op,[values]
+
+	# Range of numbers, including bounds
+	bounds = values.split(':')
+	if (len(bounds) == 2) and all(toNumber(b) is not None for b in bounds):
+		return optName,('not between' if op == '!=' else 'between'),bounds
+
+	# List of values
+	return optName,('not in' if op == '!=' else 'in'),values.split(',')
 
 # Prints basic infos about found build file
 def printBuildInfo(cid,buildCid):
@@ -1830,25 +3661,100 @@ def printBuildInfo(cid,buildCid):
 
 # Prints all defined cases
 def printCases(showDefaults=False):
-	caseNames = []
+	# Table of cases and options, as aligned table, CSV or TSV
+	if isCmdLineArgument('--withOptions') and isCmdLineArgument('--format'):
+		printCaseMatrix(getCmdLineArgument('--format'),showDefaults)
+		return
+
+	if isCmdLineArgument('--withOptions'):
+		for caseName,options in iterCaseOptionValues(showDefaults):
+			print(caseName)
+			printTable([ [o,v] for o,v in options ],4)
+		return
+
 	for row in sqlCurs.execute('''
 			SELECT caseName
 			FROM cases
 			ORDER BY caseName
 			'''):
-		caseNames.append(row[0])
+		print(row[0])
+
+# Prints one row per case and one column per option, the rows are
+# written as they are read. Widths of columns of aligned tables are
+# queried beforehand
+def printCaseMatrix(matrixFormat,showDefaults=False):
+	if matrixFormat not in ('table','csv','tsv'):
+		raise SeriesError("Not a valid format ("+matrixFormat+"), expected table, csv or tsv")
+
+	optTypes = ['case','meta'] if showDefaults else ['case']
+	optNames = sorted(getOptions(optTypes))
+	header = ['caseName']+optNames
+
+	if (matrixFormat == 'csv'):
+		writer = csv.writer(sys.stdout)
+	elif (matrixFormat == 'tsv'):
+		writer = csv.writer(sys.stdout,dialect='excel-tab',lineterminator='\n')
+	else:
+		widths = getCaseMatrixWidths(optNames,showDefaults)
+		writer = None
 
-	withOptions = isCmdLineArgument('--withOptions')
-	for caseName in caseNames:
-		print(caseName)
-		if withOptions:
-			printCaseOptions(caseName,showDefaults)
+	def writeRow(row):
+		if writer:
+			writer.writerow(row)
+		else:
+			print(" | ".join(v.ljust(w) for v,w in zip(row,widths)).rstrip())
+
+	writeRow(header)
+	for caseName,options in iterCaseOptionValues(showDefaults):
+		values = dict(options)
+		writeRow([caseName]+[ values.get(o,'') for o in optNames ])
 
 # Prints given case
 def printCaseOptions(caseName,showDefaults=False):
 	cid = isCase(caseName)
 	printCidOptions(cid,showDefaults)
 	
+# Prints history of cid with times and the options changed by each step
+def printCidHistory(cid):
+	timeFormat = '%d.%m.%Y, %H:%M'
+
+	table = []
+	previous = {}
+	for cid,timeCreated,timeBuild,options in getCidHistory(cid):
+		changes = []
+		for opt in sorted(set(previous) | set(options)):
+			if opt not in options:
+				changes.append(opt+" (default)")
+			elif opt not in previous:
+				changes.append(opt+"="+options[opt])
+			elif (options[opt] != previous[opt]):
+				changes.append(opt+": "+previous[opt]+" -> "+options[opt])
+
+		created = datetime.datetime.fromtimestamp(timeCreated).strftime(timeFormat)
+		built = ''
+		if timeBuild:
+			built = datetime.datetime.fromtimestamp(timeBuild).strftime(timeFormat)
+
+		table.append([cid,created,built,", ".join(changes)])
+		previous = options
+
+	table.insert(0,["Cid","Created","Built","Changes"])
+	printTable(table,4)
+
+# Prints ancestors, siblings and descendants of cid and the youngest
+# instance following the first son of each generation
+def printCidLineage(cid):
+	def cidList(cids):
+		return " ".join( str(c) for c in cids ) or "-"
+
+	printTable([
+		["Patriarch",getPartriarchCid(cid)],
+		["Ancestors",cidList(getAncestorCids(cid)[1:])],
+		["Siblings",cidList(getSiblingsCid(cid))],
+		["Descendants",cidList(getDescendantCids(cid))],
+		["Youngest",getYoungCid(cid)],
+		],4)
+
 # Prints given cid
 def printCidOptions(cid,showDefaults=False):
 	opts,vals,files = buildOptionsForCid(cid,showDefaults)
@@ -1877,6 +3783,37 @@ def printHelp():
 	printHelpModify()
 	printHelpPrint()
 	
+	print("\n\t--build --all\tBuilds all cases in parallel (--jobs=)")
+	print("\t\t\tUse --case= instead of --all to build matching cases")
+	print("\t\t\tUse --yes to skip the confirmation")
+	print("\n\t--where=\tSelects cases by option values instead of --all, e.g.")
+	print("\t\t\tname=a,b  name!=a  name=1:5  name<3 (also <=, >, >=)")
+	print("\t\t\tGive it several times to match all conditions. Works")
+	print("\t\t\twith --build, --run, --print, --clean, --delete, --modify")
+	print("\n\t--build --link=\tFiles without options are not copied but created as")
+	print("\t\t\treflink, hardlink or symlink to the template")
+	print("\n\t--run --all --force\tBuilds and runs all cases in parallel")
+	print("\t\t\t\t(--jobs=, --timeout= seconds per case)")
+	print("\n\t--export [--format=shell|json|csv] [--history]")
+	print("\t\t\tExports series as commands, JSON (--history includes")
+	print("\t\t\tall case instances) or CSV table of cases")
+	print("\t--import=\tImports JSON export into empty series, e.g. with")
+	print("\t\t\t--createDB=, or adds cases of CSV table")
+	print("\n\t--gc [--keep=]\tDeletes earlier case instances, except the ones cases")
+	print("\t\t\twere built from and the latest --keep ones of each case")
+	print("\n\t--lock=wait|skip\tCases built, cleaned or run by another command are")
+	print("\t\t\twaited for (default) or skipped")
+	print("\n\t--busyTimeout=\tSeconds to wait for other commands using the data base")
+	print("\t\t\t(default: "+str(busyTimeout)+")")
+	print("\n\t--wal\t\tSwitches the data base to WAL mode for good, so commands")
+	print("\t\t\treading it do not wait for ones writing it. Not for data")
+	print("\t\t\tbases on network file systems")
+	print("\n\t--profile\tPrints time of phases of the command, statements by call")
+	print("\t\t\tsite and bytes read and written to stderr, as JSON with")
+	print("\t\t\t--format=json")
+	print("\n\t--daemon\tServes commands of this directory, keeping the data base")
+	print("\t\t\topen. Commands are passed on to it automatically, unless")
+	print("\t\t\t--noDaemon is given. Stop it with --stopDaemon")
 	print("\n\t--version\tPrints current program version")
 	printHelpShortOpts()
 	
@@ -1912,6 +3849,15 @@ def printHelpAdd(offset=0):
 	print(os+'\tAdds case with default options')
 	print('')
 
+	print(os+"--sweep= --name=")
+	print(os+'\tAdds cases for all combinations of option values, e.g.')
+	print(os+'\t--sweep=mesh=1:4 --sweep=solver=cg,gmres --name=run-{mesh}-{solver}')
+	print('')
+	print(os+"--table= --name=")
+	print(os+'\tAdds cases from rows of CSV or JSON file, optionally')
+	print(os+'\tcombined with --sweep. Column caseName can replace --name')
+	print('')
+
 	print(os+"--file= --option=")
 	print(os+'\tAdds file where option is also set')
 	print('')
@@ -1991,6 +3937,14 @@ def printHelpPrint(offset=0):
 	print(os+'\tPrints case including options having default values')
 	print('')
 
+	print(os+"--case= --history")
+	print(os+'\tPrints case instances with times and changed options')
+	print('')
+
+	print(os+"--case= --lineage")
+	print(os+'\tPrints ancestors, siblings and descendants of case instance')
+	print('')
+
 	print(os+"--cases")
 	print(os+'\tPrints all cases without options')
 	print('')
@@ -2003,6 +3957,10 @@ def printHelpPrint(offset=0):
 	print(os+'\tPrints all cases including options having default values')
 	print('')
 
+	print(os+"--cases --withOptions --format=table|csv|tsv")
+	print(os+'\tPrints cases as rows and options as columns')
+	print('')
+
 	print(os+"--files")
 	print(os+'\tPrints all files')
 	print('')
@@ -2031,11 +3989,13 @@ def printHelpShortOpts(offset=0):
 	print(os+"-f --force")
 	print(os+"-h --help")
 	print(os+"-i --interactive")
+	print(os+"-j --jobs")
 	print(os+"-m --modify")
 	print(os+"-p --print")
 	print(os+"-r --run")
 	print(os+"-s --series")
 	print(os+"-t --type")
+	print(os+"-y --yes")
 	print('')
 	print(os+"-V --value")
 	print(os+"-C --case")
@@ -2071,6 +4031,46 @@ def printOptions(optType):
 	optRows.insert(0,["OID","Name","Value","Where applied"])
 	printTable(optRows)
 
+# Prints profile report to stderr, as JSON if --format=json is given
+def printProfile(report):
+	stdout = sys.stdout
+	sys.stdout = sys.stderr
+	try:
+		if isCmdLineArgument('--format') \
+			and (getCmdLineArgument('--format') == 'json'):
+			print(json.dumps(report,indent=1,sort_keys=True))
+			return
+
+		print("Profile: %.3f s, %d bytes read, %d bytes written" % (
+			report['wall'],report['bytesRead'],report['bytesWritten']))
+
+		phases = sorted(report['phases'].items(),key=lambda p: -p[1])
+		rows = [ [phase,"%.1f" % (1000*seconds)] for phase,seconds in phases ]
+		rows.insert(0,["Phase","Time [ms]"])
+		printTable(rows,2)
+
+		print("Statements by call site")
+		rows = [ [s['site'],s['count'],"%.1f" % (1000*s['time']),s['statement']]
+			for s in report['statements'] ]
+		rows.insert(0,["Site","Count","Time [ms]","Statement"])
+		printTable(rows,2)
+	finally:
+		sys.stdout = stdout
+
+# Prints progress of a long running operation, only if written to a terminal
+def printProgress(label,done,total):
+	if not sys.stdout.isatty():
+		return
+
+	percent = 100
+	if total:
+		percent = 100*done//total
+
+	sys.stdout.write("\r"+label+": "+str(percent)+"%")
+	if (done >= total):
+		sys.stdout.write("\n")
+	sys.stdout.flush()
+
 # Prints table
 def printTable(table,offset=0):
 	if (len(table) < 1): return
@@ -2092,6 +4092,187 @@ def printTable(table,offset=0):
 			rowList.append(str(col).ljust(width))
 		print(offset+" | ".join(rowList))
 
+# Counts bytes read and written if a profile is taken
+def profileBytes(read=0,written=0):
+	if profile is not None:
+		profile.bytesRead += read
+		profile.bytesWritten += written
+
+# Counts bytes of copied file if a profile is taken
+def profileCopy(fileName):
+	if profile is not None:
+		size = os.path.getsize(fileName)
+		profileBytes(size,size)
+
+# Attributes time spent within to phase if a profile is taken
+@contextlib.contextmanager
+def profilePhase(phase):
+	if profile is None:
+		yield
+		return
+
+	profile.enter(phase)
+	try:
+		yield
+	finally:
+		profile.leave()
+
+# Returns rows of CSV file (first line names columns) or JSON file (list
+# of objects) as list of dicts of column names and values. Empty cells
+# of CSV files stand for default values and are left out
+def readCaseTable(fileName,needsCaseName=False):
+	if not os.path.isfile(fileName):
+		raise SeriesError("Not a valid file ("+fileName+")")
+
+	if fileName.lower().endswith('.json'):
+		with open(fileName,'r') as f:
+			rows = json.load(f)
+
+		if not isinstance(rows,list) \
+			or not all(isinstance(r,dict) for r in rows):
+			raise SeriesError("Expected list of objects in "+fileName)
+
+		rows = [ dict((k,toText(v)) for k,v in r.items()) for r in rows ]
+
+		if needsCaseName and not all('caseName' in r for r in rows):
+			raise SeriesError("Missing column caseName in "+fileName)
+
+		return rows
+
+	with open(fileName,'r') as f:
+		rows = [ dict((toText(k),toText(v)) for k,v in r.items() if len(v) > 0)
+			for r in csv.DictReader(f) ]
+
+	if needsCaseName and not all('caseName' in r for r in rows):
+		raise SeriesError("Missing column caseName in "+fileName)
+
+	return rows
+
+# Returns entries of template files stored in cache file, none if it
+# cannot be read
+def readTemplateCache(cacheFile):
+	try:
+		with open(cacheFile,'r') as f:
+			data = json.load(f)
+	except (IOError,OSError,ValueError):
+		return {}
+
+	if not isinstance(data,dict) or (data.get('format') != 1):
+		return {}
+
+	return data['files']
+
+# Rewrites files of an existing case tree whose digests differ from the
+# digests recorded in the build files, leaving all other files, e.g.
+# results of runs, untouched. Returns false if the case tree does not
+# allow this, i.e. it is incomplete or was built by an older version
+def rebuildCaseTree(cid,digests):
+	if debug: print("rebuildCaseTree:",cid)
+
+	# Recorded digests of all template files are required
+	caseFiles = {}
+	recorded = {}
+	for tFile in digests:
+		cFile = buildFQFN(cid,tFile)
+		bFile = getBuildFile(cFile,tFile)
+		if not os.path.exists(cFile) or not os.path.isfile(bFile):
+			return False
+
+		recorded[tFile] = getBuildDigests(bFile)
+		if recorded[tFile] is None:
+			return False
+
+		caseFiles[tFile] = cFile
+
+	# Files where options are applied, by template path
+	optionFiles = {}
+	for fileName in getFiles():
+		optionFiles[os.path.normpath(getTemplatePath(fileName))] = fileName
+
+	linkMode = getLinkMode()
+	numFiles = 0
+	changed = 0
+	for tFile in sorted(digests):
+		for path in sorted(digests[tFile]):
+			numFiles += 1
+			if (recorded[tFile].get(path) == digests[tFile][path]):
+				continue
+
+			# Path of file in case tree
+			if os.path.isdir(tFile):
+				cPath = os.path.join(caseFiles[tFile],os.path.relpath(path,tFile))
+			else:
+				cPath = caseFiles[tFile]
+
+			if os.path.lexists(cPath):
+				os.remove(cPath)
+			elif not os.path.isdir(os.path.dirname(cPath) or '.'):
+				os.makedirs(os.path.dirname(cPath))
+
+			if (path in optionFiles) and getTemplateEntry(path)['optionStrings']:
+				with profilePhase('tree copy'):
+					shutil.copy2(path,cPath)
+					profileCopy(path)
+				applyOptionsToFile(cid,optionFiles[path])
+			else:
+				with profilePhase('tree copy'):
+					materializeFile(path,cPath,linkMode)
+				if path in optionFiles:
+					applyOptionsToFile(cid,optionFiles[path])
+
+			changed += 1
+
+	print(getCaseName(cid)+": rewrote "+str(changed)+" of "+str(numFiles)+" files")
+
+	return True
+
+# Creates copy-on-write clone of file, raises IOError if the file
+# system does not support it
+def reflinkFile(source,target):
+	if fcntl is None:
+		raise IOError("Reflinks not supported")
+
+	# FICLONE ioctl of Linux
+	with open(source,'rb') as s:
+		with open(target,'wb') as t:
+			fcntl.ioctl(t.fileno(),0x40049409,s.fileno())
+
+# Rejects clients of the daemon while it serves a command, until stop
+# becomes readable. Clients then run their commands without the daemon
+def rejectClients(server,stop):
+	while True:
+		readable = select.select([server,stop],[],[])[0]
+		if stop in readable:
+			break
+
+		# Request is read first, so the client is done sending
+		try:
+			conn,address = server.accept()
+			conn.settimeout(1)
+			conn.makefile('r').readline()
+			conn.sendall(toBytes(json.dumps({'rejected': True})+"\n"))
+			conn.close()
+		except socket.error:
+			pass
+
+# Releases all locks of cases held by this process, e.g. after a
+# command of the daemon failed
+def releaseLocks():
+	for lockFile in list(heldLocks):
+		del heldLocks[lockFile]
+		try:
+			os.remove(lockFile)
+		except OSError:
+			pass
+
+# Closes pool of worker processes unless it is kept by the daemon
+def releaseWorkerPool(pool):
+	if (pool is workerPool):
+		return
+
+	pool.close()
+	pool.join()
+
 # Resets all tables to initial state
 def resetTables():
 	print("resetTables() needs better implementation")
@@ -2099,9 +4280,11 @@ def resetTables():
 	sqlCurs.execute('DELETE FROM options WHERE optionType!=?',('series',))
 	sqlCurs.execute('DELETE FROM cases')
 	sqlCurs.execute('DELETE FROM caseData')
+	sqlCurs.execute('DELETE FROM caseOptions')
 	sqlCurs.execute('DELETE FROM files')
 
 	sqlCurs.execute('UPDATE options SET fidString="" WHERE optionName="templateFiles"')
+	clearCatalog()
 
 # Builds case in auto mode, runs it afterwards
 def runCase(caseName):
@@ -2112,34 +4295,726 @@ def runCase(caseName):
 # Builds case in auto mode, runs it afterwards
 def runCid(cid):
 	if debug: print('runCid: ',cid)
-	
+	runCids([cid])
+
+# Builds cases and runs their run files concurrently, at most --jobs
+# cases at a time. A case takes one of the jobs from the start of its
+# build to the end of its runs, its run files are run one after another
+# once its build finished. Raises SeriesError if any build or run
+# failed, or a case exceeded the time given by --timeout
+def runCids(cids):
+	if debug: print('runCids: ',cids)
+
 	if not isCmdLineArgument('--force','-f'):
-		print("Use of --force flag is mandatory when running cases")
-		sys.exit(1)
+		raise SeriesError("Use of --force flag is mandatory when running cases")
 
-	buildCid(cid)
+	jobs = min(getJobs(),len(cids))
+	timeout = getRunTimeout()
+	lockPolicy = getLockPolicy()
+	summary = (len(cids) > 1)
 
-	cwd = os.getcwd()
 	oid = isOption('runFiles')
 	runFids = getFidsOfOid(oid)
-	for runFid in runFids:
-		runFile,runDir = getRunFileAndDir(cid,runFid)
-		if debug: print('runCase: runFile,runDir ',runFile,runDir)
-		os.chdir(runDir)
-		if debug: print('runCase: running ',runFile)
-		os.system("./"+runFile)
-		os.chdir(cwd)
+
+	# Builds are done by a pool, or one by one in this process, e.g.
+	# within a batch
+	pool = None
+	if (jobs > 1) and not inBatch:
+		pool = getWorkerPool(jobs)
+
+	toBuild = list(cids)
+	building = []
+	built = []
+	running = []
+	failed = []
+	skipped = []
+	announced = set()
+
+	# Lock of case is held from its build to the end of its runs
+	def finishBuild(cid,result):
+		caseName,status,output,report = result
+		mergeProfile(report)
+		sys.stdout.write(output)
+		if (status == 'done'):
+			built.append(cid)
+			return
+
+		unlockCase(cid)
+		if (status == 'skipped'):
+			skipped.append(caseName)
+		else:
+			print(caseName+": build FAILED")
+			failed.append(caseName)
+
+	# Time of builds in this process is subtracted from the run phase
+	with profilePhase('run'):
+		while toBuild or building or built or running:
+
+			# Start builds while there are free slots, cases locked by
+			# another process are tried again later
+			waiting = []
+			while toBuild and (len(building)+len(built)+len(running) < jobs):
+				cid = toBuild.pop(0)
+				if not lockCase(cid):
+					if (lockPolicy == 'skip'):
+						print(getCaseName(cid)+": locked by "+getLockHolder(cid)+", skipped")
+						skipped.append(getCaseName(cid))
+					else:
+						if cid not in announced:
+							print(getCaseName(cid)+": waiting for lock held by "+getLockHolder(cid))
+							announced.add(cid)
+						waiting.append(cid)
+					continue
+
+				task = (cid,opts,True)
+				if pool:
+					building.append((cid,pool.apply_async(buildCidWorker,(task,))))
+				else:
+					with profilePhase('build'):
+						result = buildCidWorker(task)
+					finishBuild(cid,result)
+			toBuild = waiting+toBuild
+
+			# Collect finished builds
+			for entry in list(building):
+				cid,result = entry
+				if not result.ready(): continue
+				building.remove(entry)
+				finishBuild(cid,result.get())
+
+			# Start runs of built cases
+			while built:
+				cid = built.pop(0)
+				runs = [ getRunFileAndDir(cid,runFid) for runFid in runFids ]
+				case = {
+					'cid': cid,
+					'name': getCaseName(cid),
+					'runs': runs,
+					'process': None,
+					'start': time.time(),
+					'killed': 0,
+					}
+				if startNextRun(case):
+					running.append(case)
+				else:
+					unlockCase(cid)
+					if summary: print(case['name']+": done")
+
+			# Check running cases
+			for case in list(running):
+				returnCode = case['process'].poll()
+				forwardRunOutput(case,returnCode is not None)
+
+				if returnCode is None:
+					if timeout and not case['killed'] \
+						and (time.time()-case['start'] > timeout):
+						print(case['name']+": timeout after "+str(timeout)+" s")
+						killRun(case['process'],signal.SIGTERM)
+						case['killed'] = time.time()
+					elif case['killed'] and (time.time()-case['killed'] > 5):
+						killRun(case['process'],signal.SIGKILL)
+					continue
+
+				if case['killed']:
+					print(case['name']+": run FAILED (timeout)")
+					failed.append(case['name'])
+				elif (returnCode != 0):
+					print(case['name']+": run FAILED (exit code "+str(returnCode)+")")
+					failed.append(case['name'])
+				elif startNextRun(case):
+					continue
+				elif summary:
+					print(case['name']+": done")
+
+				running.remove(case)
+				unlockCase(case['cid'])
+
+			if building or running or built or toBuild:
+				time.sleep(0.05)
+
+	if pool:
+		releaseWorkerPool(pool)
+
+	if summary:
+		ran = len(cids)-len(failed)-len(skipped)
+		print("Ran "+str(ran)+" of "+str(len(cids))+" cases")
+	if (len(failed) > 0):
+		raise SeriesError("Failed: "+", ".join(sorted(failed)))
+
+# Runs command given by the command line arguments on the connected DB
+def runCommand():
+	if debug: print('runCommand: ',opts)
+	checkCatalog()
+
+	# Run command again while taking a profile
+	if isCmdLineArgument('--profile') and (profile is None):
+		startProfile()
+		try:
+			runCommand()
+		finally:
+			printProfile(stopProfile())
+		return
+
+	# Do everything related to a specific case
+	if isCmdLineArgument('--case','-C'):
+		handleCmdCase(getCmdLineArgument('--case','-C'));
+
+	# Do everything related to all cases matching --where
+	elif isCmdLineArgument('--where'):
+		cids = getCidsWhere(getWhere())
+		if (len(cids) == 0):
+			raise SeriesError("No matching cases")
+
+		handleCidMulti(cids)
+
+	# Do everything related to all cases
+	elif isCmdLineArgument('--all'):
+		cids = getAllCids()
+		if (len(cids) == 0):
+			raise SeriesError("No cases")
+
+		handleCidMulti(cids)
+
+	# Anything else that is not related to a specific case
+	# Adding something
+	elif isCmdLineArgument('--add','-a'):
+
+		# Add cases in bulk
+		if isCmdLineArgument('--sweep') or isCmdLineArgument('--table'):
+			addCasesBySweep()
+
+		# Add global option of specified type
+		elif (isCmdLineArgument('--option','-O')) \
+			and (isCmdLineArgument('--type','-t')):
+			addOptionWithType(
+				getCmdLineArgument('--option','-O'),
+				getCmdLineArgument('--type','-t')
+				)
+
+		# Add global option of type 'case'
+		elif (isCmdLineArgument('--option','-O')) \
+			and (isCmdLineArgument('--value','-V')) \
+			and (isCmdLineArgument('--file','-F')):
+			addOption(
+				getCmdLineArgument('--option','-O'),
+				getCmdLineArgument('--value','-V'),
+				'case',
+				getCmdLineArgument('--file','-F')
+				)
+
+		# Add file to global option
+		elif (isCmdLineArgument('--file','-F')) \
+			and (isCmdLineArgument('--option','-O')):
+			addFileToOption(
+				getCmdLineArgument('--file','-F'),
+				getCmdLineArgument('--option','-O')
+				)
+
+		# File
+		elif isCmdLineArgument('--file','-F'):
+			addFile(getCmdLineArgument('--file','-F'))
+
+		# Template
+		elif isCmdLineArgument('--template','-T'):
+			addTemplate(getCmdLineArgument('--template','-T'))
+
+		# Runfile
+		elif isCmdLineArgument('--runFile'):
+			addFileToOption(
+				getCmdLineArgument('--runFile'),
+				'runFiles'
+				)
+
+		# Unspecified
+		else:
+			printHelpAdd()
+
+	# Delete something
+	elif isCmdLineArgument('--delete','-d'):
+
+		# Delete file from option
+		if (isCmdLineArgument('--file','-F')) \
+			and (isCmdLineArgument('--option','-O')):
+			delFileFromOption(
+				getCmdLineArgument('--option','-O'),
+				getCmdLineArgument('--file','-F')
+			)
+
+		# Delete option
+		elif isCmdLineArgument('--option','-O'):
+			delOption(getCmdLineArgument('--option','-O'))
+		
+		# Unspecified
+		else:
+			printHelpDelete()
+
+	# Export
+	elif isCmdLineArgument('--export'):
+		exportFormat = 'shell'
+		if isCmdLineArgument('--format'):
+			exportFormat = getCmdLineArgument('--format')
+
+		if (exportFormat == 'json'):
+			exportJSON(isCmdLineArgument('--history'))
+		elif (exportFormat == 'csv'):
+			exportCSV()
+		elif (exportFormat == 'shell'):
+			export()
+		else:
+			raise SeriesError("Not a valid export format ("+exportFormat+")")
+
+	# Delete case instances not needed anymore
+	elif isCmdLineArgument('--gc'):
+		delHistory(
+			getKeep(),
+			isCmdLineArgument('--force','-f') or isCmdLineArgument('--yes','-y')
+			)
+
+	# Import
+	elif isCmdLineArgument('--import'):
+		importSeries(getCmdLineArgument('--import'))
+
+	# Modify something
+	elif isCmdLineArgument('--modify','-m'):
+
+		# Modify name of option
+		if (isCmdLineArgument('--option','-O')) \
+			and isCmdLineArgument('--name'):
+			modOptionName(
+				getCmdLineArgument('--option','-O'),
+				getCmdLineArgument('--name')
+				)
+
+		# Modify value of option
+		elif (isCmdLineArgument('--option','-O')) \
+			and (isCmdLineArgument('--value','-V')):
+			modOptionValue(
+				getCmdLineArgument('--option','-O'),
+				getCmdLineArgument('--value','-V')
+				)
+
+		# Unspecified
+		else:
+			printHelpModify()
+
+	# Print something
+	elif isCmdLineArgument('--print','-p'):
+
+		# Cases including default options
+		if isCmdLineArgument('--cases') and isCmdLineArgument('--default'):
+			printCases(True)
+
+		# Cases
+		elif isCmdLineArgument('--cases'): printCases()
+
+		# All files
+		elif isCmdLineArgument('--files'): printFiles()
+
+		# Print series options
+		elif isCmdLineArgument('--options') \
+		and isCmdLineArgument('--series','-s'):
+			printOptions('series')
+
+		# Print case and meta options
+		elif isCmdLineArgument('--options'):
+			print('Meta options')
+			printOptions('meta')
+			print('')
+			print('Regular options')
+			printOptions('case')
+
+		# Unspecified
+		else:
+			printHelpPrint()
+
+	# Reset DB to initial state
+	elif isCmdLineArgument('--reset'):
+		resetTables()
+
+	# Stopping the daemon is handled by the daemon itself
+	elif isCmdLineArgument('--stopDaemon'):
+		raise SeriesError("No daemon running")
+
+	# Options incorrect
+	else:
+		printHelp()
+		sys.exit(1)
+
+# Writes cache of parsed template files, keeping entries added by other
+# processes meanwhile. The file is replaced at once
+def saveTemplateCache():
+	cacheFile = templateCache['file']
+	files = readTemplateCache(cacheFile)
+	files.update(templateCache['files'])
+	templateCache['files'] = files
+	templateCache['unsaved'] = False
+
+	dirName,baseName = os.path.split(cacheFile)
+	fd,tmpFile = tempfile.mkstemp(prefix=baseName+".",dir=dirName or ".")
+	try:
+		with os.fdopen(fd,'w') as f:
+			json.dump({'format': 1,'files': files},f)
+		os.rename(tmpFile,cacheFile)
+	except BaseException:
+		if os.path.exists(tmpFile):
+			os.remove(tmpFile)
+		raise
+
+# Returns list of offsets and option strings matched by pattern in source
+# file, read in blocks of constant size
+def scanOptionStrings(pattern,tokens,source):
+	# Files are handled as bytes, as they might be in any encoding
+	names = {}
+	for token in tokens:
+		names[toBytes(token)] = token
+
+	pattern = re.compile(toBytes(pattern.pattern))
+	maxLen = max(len(t) for t in names)
+
+	matches = []
+	offset = 0
+	rest = b""
+	while True:
+		block = source.read(chunkSize)
+		data = rest + block
+
+		# Option strings starting before end are complete, the ones
+		# starting after it might continue in the next block
+		end = len(data)
+		if block:
+			end = max(0,len(data)-maxLen+1)
+
+		pos = 0
+		for match in pattern.finditer(data):
+			if (match.start() >= end): break
+			matches.append((offset+match.start(),names[match.group(0)]))
+			pos = match.end()
+
+		end = max(pos,end)
+		rest = data[end:]
+		offset += end
+
+		if not block: break
+
+	profileBytes(offset)
+	return matches
+
+# Serves commands sent through a Unix socket next to the DB, keeping the
+# connection, caches and a pool of worker processes across commands
+def serveDaemon():
+	global workerPool,captureRunOutput
+
+	socketFile = getSocketFile(dbFile)
+	if os.path.exists(socketFile):
+		probe = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+		try:
+			probe.connect(socketFile)
+			probe.close()
+			raise SeriesError("Daemon already running ("+socketFile+")")
+		except socket.error:
+			# Left over by a daemon that did not stop cleanly
+			os.remove(socketFile)
+
+	# Only accessible by the user from the start
+	server = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+	umask = os.umask(0o177)
+	try:
+		server.bind(socketFile)
+	finally:
+		os.umask(umask)
+	server.listen(16)
+
+	workerPool = multiprocessing.Pool(getJobs(),initWorker,(dbFile,))
+
+	# Stop on signals as well, removing the socket
+	def stop(signum,frame):
+		raise KeyboardInterrupt
+	signal.signal(signal.SIGTERM,stop)
+	captureRunOutput = True
+	cwd = os.getcwd()
+	stopRead,stopWrite = os.pipe()
+	print("Serving "+dbFile+" on "+socketFile)
+	sys.stdout.flush()
+
+	try:
+		while True:
+			conn,address = server.accept()
+
+			# Clients send their request right away
+			conn.settimeout(1)
+			try:
+				request = json.loads(conn.makefile('r').readline())
+			except (ValueError,socket.error):
+				conn.close()
+				continue
+			conn.settimeout(None)
+
+			# Relative file names only work in the directory of the daemon
+			if (request.get('cwd') != cwd):
+				conn.sendall(toBytes(json.dumps({'rejected': True})+"\n"))
+				conn.close()
+				continue
+
+			if '--stopDaemon' in request['argv']:
+				message = {'out': "Daemon stopped\n"}
+				conn.sendall(toBytes(json.dumps(message)+"\n"))
+				conn.sendall(toBytes(json.dumps({'exit': 0})+"\n"))
+				conn.close()
+				break
+
+			# One command at a time, as commands use the globals. Clients
+			# coming meanwhile are rejected and run their commands themselves
+			rejecting = threading.Thread(target=rejectClients,args=(server,stopRead))
+			rejecting.daemon = True
+			rejecting.start()
+			try:
+				status = serveRequest(conn,request['argv'])
+			finally:
+				os.write(stopWrite,b"x")
+				rejecting.join()
+				os.read(stopRead,1)
+
+			try:
+				conn.sendall(toBytes(json.dumps({'exit': status})+"\n"))
+			except socket.error:
+				pass
+			conn.close()
+
+	except KeyboardInterrupt:
+		pass
+
+	finally:
+		server.close()
+		if os.path.exists(socketFile):
+			os.remove(socketFile)
+		workerPool.terminate()
+		workerPool = None
+		os.close(stopRead)
+		os.close(stopWrite)
+
+# Runs command of a request to the daemon, writing output to conn, and
+# returns exit status. Changes are committed only if the command
+# finished, just like it happens for a command run directly
+def serveRequest(conn,argv):
+	global opts,optNames
+
+	stdout,stderr,stdin = sys.stdout,sys.stderr,sys.stdin
+	sys.stdout = sys.stderr = SocketOutput(conn)
+	sys.stdin = StringIO()
+
+	status = 0
+	try:
+		opts,args = getArgs(shortOpts,longOpts,argv)
+		if (len(opts) == 0):
+			printHelp()
+			sys.exit(1)
+		optNames = [ o[0] for o in opts ]
+
+		runCommand()
+
+	except SystemExit as e:
+		status = e.code
+		if status is None:
+			status = 0
+		elif not isinstance(status,int):
+			print(status)
+			status = 1
+
+	except SeriesError as e:
+		print(e)
+		status = 1
+
+	except EOFError:
+		print("")
+		print("Cannot ask through the daemon, use --yes or --force,")
+		print("or run with --noDaemon")
+		status = 1
+
+	except Exception:
+		traceback.print_exc(file=sys.stdout)
+		status = 1
+
+	finally:
+		sys.stdout,sys.stderr,sys.stdin = stdout,stderr,stdin
+		releaseLocks()
+
+	if (status == 0):
+		sqlCurs.connection.commit()
+	else:
+		sqlCurs.connection.rollback()
+		clearCatalog()
+
+	return status
+
+# Starts next run file of case in its run directory, returns false if
+# there is no run file left
+def startNextRun(case):
+	if (len(case['runs']) == 0):
+		return False
+
+	runFile,runDir = case['runs'].pop(0)
+	if debug: print('startNextRun: runFile,runDir ',runFile,runDir)
+
+	# Output is passed on by forwardRunOutput if it cannot be inherited
+	output = None
+	if captureRunOutput:
+		output = subprocess.PIPE
+
+	# Working directory of the process only, not of series itself.
+	# Own process group, so a timeout can stop all children of run file
+	case['process'] = subprocess.Popen(
+		"./"+runFile,
+		shell=True,
+		cwd=runDir,
+		preexec_fn=os.setsid,
+		stdout=output,
+		stderr=subprocess.STDOUT if output else None,
+		)
+
+	return True
+
+# Starts taking a profile, statements are counted by a cursor wrapping
+# the one in use
+def startProfile():
+	global profile,sqlCurs
+	profile = Profile()
+	sqlCurs = ProfilingCursor(sqlCurs)
+	profile.enter('other')
+
+# Stops taking the profile, returns its report
+def stopProfile():
+	global profile,sqlCurs
+	profile.leave()
+	report = profile.report()
+	sqlCurs = sqlCurs.cursor
+	profile = None
+
+	return report
+
+# Returns a string where all option strings matched by pattern are
+# replaced by their values, as well as a list of options applied
+def substituteOptions(pattern,tokens,inputString):
+	if pattern is None:
+		return inputString,[]
+
+	appliedOpts = []
+
+	def substitute(match):
+		opt,value = tokens[match.group(0)]
+		if opt not in appliedOpts:
+			appliedOpts.append(opt)
+		return value
+
+	adaptedString = pattern.sub(substitute,inputString)
+
+	return adaptedString,appliedOpts
+
+# Copies source to target file replacing the option strings at the given
+# offsets by their values, in blocks of constant size. Returns number of
+# bytes read and written and list of options applied
+def spliceOptionsIntoFile(matches,tokens,source,target):
+	read = 0
+	written = 0
+	appliedOpts = []
+
+	# Files are handled as bytes, as they might be in any encoding
+	values = {}
+	for token,(opt,value) in tokens.items():
+		values[toBytes(token)] = (opt,toBytes(value))
+
+	# Copies size bytes, or all that are left
+	def copy(size=None):
+		copied = 0
+		while (size is None) or (copied < size):
+			block = source.read(chunkSize if size is None else min(chunkSize,size-copied))
+			if not block: break
+			target.write(block)
+			copied += len(block)
+		return copied
+
+	pos = 0
+	for offset,token in matches:
+		token = toBytes(token)
+		opt,value = values[token]
+		if opt not in appliedOpts:
+			appliedOpts.append(opt)
+
+		copied = copy(offset-pos)
+		skipped = len(source.read(len(token)))
+		target.write(value)
+
+		read += copied+skipped
+		written += copied+len(value)
+		pos = offset+len(token)
+
+	copied = copy()
+	read += copied
+	written += copied
+
+	return read,written,appliedOpts
+
+# Returns string encoded as bytes, e.g. for hashing
+def toBytes(s):
+	if isinstance(s,bytes):
+		return s
+
+	return s.encode('utf-8')
+
+# Returns string as str, i.e. encoded as UTF-8 for Python 2, e.g. for
+# the csv module
+def toStr(s):
+	if isinstance(s,str):
+		return s
+
+	return s.encode('utf-8')
+
+# Returns value as number if it is a finite one, None otherwise. Used
+# in SQL as well, see connectDB
+def toNumber(v):
+	try:
+		number = float(v)
+	except (TypeError,ValueError):
+		return None
+
+	if (number != number) or (abs(number) == float('inf')):
+		return None
+
+	return number
+
+# Returns value as unicode text, e.g. an option value given as number or
+# as UTF-8 encoded bytes
+def toText(v):
+	if isinstance(v,bytes):
+		return v.decode('utf-8')
+
+	if isinstance(v,type(u"")):
+		return v
+
+	return type(u"")(v)
+
+# Releases lock of case held by this process
+def unlockCase(cid):
+	lockFile = getLockFile(cid)
+	heldLocks[lockFile] -= 1
+	if (heldLocks[lockFile] > 0):
+		return
+
+	del heldLocks[lockFile]
+	try:
+		os.remove(lockFile)
+	except OSError:
+		pass
 
 # Updates time of last build and increments number of builds
 def updateCaseBuildData(caseName):
 	cid = verifyCase(caseName)
-	builds = getCaseBuilds(caseName)
 	tstamp = int(time.time())
 
-	insert = (tstamp,builds+1,cid)
+	# Incremented by the data base, so concurrent builds are all counted
+	insert = (tstamp,cid)
 	sqlCurs.execute('''
 		UPDATE caseData
-		SET timeBuild=?,builds=?
+		SET timeBuild=?,builds=builds+1
 		WHERE cid=?''',insert)
 
 # Updates currend cid of case entry in table cases
@@ -2152,257 +5027,397 @@ def updateCurrentCid(oldCid,newCid):
 		SET currentCid=?
 		WHERE caseName=?''',insert)
 
-# Returns fid if case is in DB, exits otherwise
+# Returns fid if case is in DB, raises SeriesError otherwise
 def verifyCase(caseName):
 	cid = isCase(caseName)
 	if not cid:
-		print("Not a valid case ("+caseName+")")
-		sys.exit(1)
+		raise SeriesError("Not a valid case ("+caseName+")")
 	else:
 		return cid
 
-# Exits if given cid is not valid
+# Raises SeriesError if given cid is not valid
 def verifyCid(cid,isCurrentCid=False):
 	cid = int(cid)
 	if not isCid(cid,isCurrentCid):
 		if isCurrentCid:
-			print("Not a current valid case id ("+str(cid)+")")
-		else:
-			print("Not a valid case id ("+str(cid)+")")
-		sys.exit(1)
+			raise SeriesError("Not a current valid case id ("+str(cid)+")")
+		raise SeriesError("Not a valid case id ("+str(cid)+")")
 	else:
 		return cid
 
-# Exits if given fid is not valid
+# Raises SeriesError if given fid is not valid
 def verifyFid(fid):
 	fid = int(fid)
 	if not isFid(fid):
-		print("Not a valid file id ("+str(fid)+")")
-		sys.exit(1)
+		raise SeriesError("Not a valid file id ("+str(fid)+")")
 
-# Returns fid if fileName is in DB, exits otherwise
+# Returns fid if fileName is in DB, raises SeriesError otherwise
 def verifyFile(fileName):
 	fid = isFile(fileName)
 	if not fid:
-		print("Not a valid file ("+fileName+")")
-		sys.exit(1)
+		raise SeriesError("Not a valid file ("+fileName+")")
 	else:
 		return fid
 
-# Exits if given option is not a valid meta option
+# Raises SeriesError if given option is not a valid meta option
 def verifyMetaOption(optName):
 	if optName not in metaOptions:
-		print('Not a valid meta option ('+optName+')')
-		sys.exit(1)
+		raise SeriesError('Not a valid meta option ('+optName+')')
 
-# Returns oid if option is in DB, exits otherwise
+# Returns oid if option is in DB, raises SeriesError otherwise
 def verifyOption(optName,optType='any'):
 	verifyOptionType(optType)
 	oid = isOption(optName,optType)
 	if not oid:
-		print("Not a valid option ("+optName+")")
-		sys.exit(1)
+		raise SeriesError("Not a valid option ("+optName+")")
 	else:
 		return oid
 
-# Exits if given type is not a valid option type
+# Raises SeriesError if given type is not a valid option type
 def verifyOptionType(optType):
 	optTypes = ('any','case','meta','series')
 
 	if type(optType) is str:
 		if optType not in optTypes:
-			print('Not a valid option type ('+optType+')')
-			sys.exit(1)
+			raise SeriesError('Not a valid option type ('+optType+')')
 
 	elif type(optType) is list:
 		for o in optType:
 			verifyOptionType(o)
 
 	else:
-		print('Not a valid option type (',optType,')')
-		print('type: ',type(optType))
-		sys.exit(1)
+		raise SeriesError('Not a valid option type ('+str(optType)+')')
+
+# Writes build file recording cid and fingerprint of build, followed
+# by the digests of the files the case tree was built from
+def writeBuildFile(buildFile,cid,fingerprint='',digests={}):
+	with open(buildFile,'w') as f:
+		f.write(str(cid)+"\n"+fingerprint+"\n")
+		for path in sorted(digests):
+			f.write(digests[path]+" "+path+"\n")
+
+# Writes build files of all template files of cid
+def writeBuildFiles(cid,fingerprint,digests):
+	for tFile in getFilesOfOption('templateFiles'):
+		cFile = buildFQFN(cid,tFile)
+		bFile = getBuildFile(cFile,tFile)
+		writeBuildFile(bFile,cid,fingerprint,digests.get(tFile,{}))
+
+# Writes list of objects as member of a JSON object, one item per line
+def writeJSONList(out,key,items,last=False):
+	out.write(json.dumps(key)+': [')
+	separator = '\n'
+	for item in items:
+		out.write(separator+json.dumps(item,sort_keys=True))
+		separator = ',\n'
+	out.write('\n]'+('\n' if last else ',\n'))
 
 #
-# Main -----------------------------------------------------------------
+# Session --------------------------------------------------------------
 #
 
-opts, args = getArgs(shortOpts,longOpts)
-
-if (len(opts) == 0):
-	printHelp()
-	sys.exit(1)
-
-optNames,optVals = zip(*opts)
-sqlCurs = [None]
-
-if isCmdLineArgument('--help','-h'):
-	printHelp()
-	sys.exit(0)
-
-if isCmdLineArgument('--version'):
-	print("Version "+str(version))
-	sys.exit(0)
-
-if isCmdLineArgument('--createDB'):
-	createDB(getCmdLineArgument('--createDB'))
-	sys.exit(0)
-
-for f in os.listdir("./"):
-    if f.endswith(".db"):
-        dbFile = f
-
-if isCmdLineArgument("--db"):
-	dbFile = getCmdLineArgument("--db")
-
-if not os.path.isfile(dbFile):
-	print("Cannot find database.")
-	sys.exit(1)
-else:
-	sqlCon = sqlite3.connect(dbFile)
-	sqlCurs = sqlCon.cursor()
-
-
-# Do everything related to a specific case
-if isCmdLineArgument('--case','-C'):
-	handleCmdCase(getCmdLineArgument('--case','-C'));
-
-
-# Anything else that is not related to a specific case
-# Adding something
-elif isCmdLineArgument('--add','-a'):
-
-	# Add global option of specified type
-	if (isCmdLineArgument('--option','-O')) \
-		and (isCmdLineArgument('--type','-t')):
-		addOptionWithType(
-			getCmdLineArgument('--option','-O'),
-			getCmdLineArgument('--type','-t')
-			)
-
-	# Add global option of type 'case'
-	elif (isCmdLineArgument('--option','-O')) \
-		and (isCmdLineArgument('--value','-V')) \
-		and (isCmdLineArgument('--file','-F')):
-		addOption(
-			getCmdLineArgument('--option','-O'),
-			getCmdLineArgument('--value','-V'),
-			'case',
-			getCmdLineArgument('--file','-F')
-			)
-
-	# Add file to global option
-	elif (isCmdLineArgument('--file','-F')) \
-		and (isCmdLineArgument('--option','-O')):
-		addFileToOption(
-			getCmdLineArgument('--file','-F'),
-			getCmdLineArgument('--option','-O')
-			)
-
-	# File
-	elif isCmdLineArgument('--file','-F'):
-		addFile(getCmdLineArgument('--file','-F'))
-
-	# Template
-	elif isCmdLineArgument('--template','-T'):
-		addTemplate(getCmdLineArgument('--template','-T'))
-
-	# Runfile
-	elif isCmdLineArgument('--runFile'):
-		addFileToOption(
-			getCmdLineArgument('--runFile'),
-			'runFiles'
-			)
-
-	# Unspecified
-	else:
-		printHelpAdd()
+# Data base of a series opened for use as a library. The functions above
+# work on the global cursor and command line options, a session points
+# them to its own connection and to the options of the method called.
+# Methods raise SeriesError instead of exiting and commit their changes,
+# unless called within batch(), which commits all changes at its end.
+# Builds and runs are done by separate processes and commit right away,
+# within a batch cases are built in this process
+class Session(object):
+	def __init__(self,dbName=None,jobs=None,output=None):
+		if dbName is None:
+			dbName = findDbFile()
+
+		if (dbName is None) or not os.path.isfile(dbName):
+			raise SeriesError("Cannot find database.")
+
+		self.dbFile = dbName
+		self.jobs = jobs
+		self.output = output
+		self.batchDepth = 0
+		self.connection = connectDB(dbName)
+		self.cursor = self.connection.cursor()
+
+		with self.use():
+			migrateDB()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,excType,excValue,tb):
+		self.close()
+
+	# Groups calls of methods into one transaction
+	@contextlib.contextmanager
+	def batch(self):
+		self.batchDepth += 1
+		try:
+			yield self
+		except BaseException:
+			self.batchDepth -= 1
+			if (self.batchDepth == 0):
+				self.connection.rollback()
+				clearCatalog()
+			raise
+
+		self.batchDepth -= 1
+		if (self.batchDepth == 0):
+			self.connection.commit()
+
+	def close(self):
+		self.connection.close()
+
+	# Returns command line options for flags and options with values
+	def cmdOpts(self,*flags,**values):
+		cmdOpts = [ (f,'') for f in flags ]
+		if self.jobs and ('jobs' not in values):
+			values['jobs'] = self.jobs
+
+		for name,value in sorted(values.items()):
+			if value is not None:
+				cmdOpts.append(('--'+name,str(value)))
+
+		return cmdOpts
+
+	# Points the module globals to this session while a method is
+	# called, commits or rolls back changes of the call
+	@contextlib.contextmanager
+	def use(self,cmdOpts=()):
+		global sqlCurs,dbFile,opts,optNames,inBatch
+
+		saved = (sqlCurs,dbFile,opts,optNames,inBatch,sys.stdout)
+		sqlCurs = self.cursor
+		inBatch = (self.batchDepth > 0)
+		dbFile = self.dbFile
+		opts = list(cmdOpts)
+		optNames = [ o[0] for o in opts ]
+		if self.output is not None:
+			sys.stdout = self.output
 
-# Delete something
-elif isCmdLineArgument('--delete','-d'):
+		try:
+			if (self.batchDepth == 0):
+				checkCatalog()
+			yield
+			if (self.batchDepth == 0):
+				self.connection.commit()
+		except BaseException:
+			if (self.batchDepth == 0):
+				self.connection.rollback()
+				clearCatalog()
+			raise
+		finally:
+			sqlCurs,dbFile,opts,optNames,inBatch,sys.stdout = saved
+
+	# Returns cids of given cases, or of all cases
+	def cidsOf(self,caseNames=None):
+		if caseNames is None:
+			return getAllCids()
+
+		if isinstance(caseNames,(str,type(u""))):
+			caseNames = [caseNames]
+
+		return [ verifyCase(caseName) for caseName in caseNames ]
+
+	# Adds case, optionally as copy of another case, and returns its cid
+	def addCase(self,caseName,options=None,copyFrom=None):
+		with self.use():
+			if copyFrom is None:
+				return addCases([(caseName,dict(options or {}))])[0]
+
+			cid = addCaseByCopy(caseName,copyFrom)
+			if options:
+				modOptionValuesOfCids([(cid,options)],False)
+
+			return cid
+
+	# Adds cases given as list of pairs of name and dict of option values
+	def addCases(self,cases):
+		if isinstance(cases,dict):
+			cases = cases.items()
+
+		with self.use():
+			return addCases([ (n,dict(v)) for n,v in cases ])
+
+	def addFile(self,fileName,optName=None):
+		with self.use():
+			if optName is None:
+				return addFile(fileName)
+
+			addFileToOption(fileName,optName)
+
+	def addOption(self,optName,value,fileName='none',optType='case'):
+		with self.use():
+			addOption(optName,value,optType,fileName)
+
+	def addRunFile(self,fileName):
+		with self.use():
+			addFileToOption(fileName,'runFiles')
+
+	def addTemplate(self,tmplFile):
+		with self.use():
+			addTemplate(tmplFile)
+
+	# Builds given cases, or all cases. Up-to-date cases are skipped
+	# unless force is set
+	def build(self,caseNames=None,force=False,jobs=None,link=None):
+		flag = '--force' if force else '--auto'
+		with self.use(self.cmdOpts(flag,jobs=jobs,link=link)):
+			buildCids(self.cidsOf(caseNames))
+
+	# Returns names of all cases
+	def cases(self):
+		with self.use():
+			return [ r[0] for r in sqlCurs.execute(
+				'SELECT caseName FROM cases ORDER BY caseName') ]
+
+	# Returns history of case, see getCidHistory
+	def history(self,caseName):
+		with self.use():
+			return getCidHistory(verifyCase(caseName))
+
+	# Returns dict of lists of ancestors, siblings and descendants of the
+	# current instance of case
+	def lineage(self,caseName):
+		with self.use():
+			cid = verifyCase(caseName)
+			return {
+				'ancestors': getAncestorCids(cid)[1:],
+				'siblings': getSiblingsCid(cid),
+				'descendants': getDescendantCids(cid),
+				}
+
+	# Returns names of cases where option is set to value
+	def casesWithOption(self,optName,value):
+		with self.use():
+			cids = getCidsWithOptionValue(optName,value)
+			return sorted(getCaseName(cid) for cid in cids)
+
+	# Returns names of cases matching all conditions, given as for --where
+	def casesWhere(self,*conditions):
+		with self.use():
+			cids = getCidsWhere([ parseWhere(c) for c in conditions ])
+			names = dict(sqlCurs.execute('SELECT currentCid,caseName FROM cases'))
+			return [ names[cid] for cid in cids ]
+
+	def deleteCase(self,caseName):
+		with self.use():
+			delCase(caseName,True)
+
+	# Deletes case instances not needed anymore, see delHistory
+	def deleteHistory(self,keep=0):
+		with self.use():
+			delHistory(keep,True)
+
+	def deleteOption(self,optName):
+		with self.use():
+			delOption(optName,True)
+
+	# Sets options of a case, given as dict, in one new case instance
+	def modify(self,caseName,options):
+		self.modifyCases([(caseName,options)])
+
+	# Sets options of many cases, given as list of pairs of case name
+	# and dict of option values
+	def modifyCases(self,changes):
+		if isinstance(changes,dict):
+			changes = changes.items()
+
+		with self.use():
+			cids = [ (verifyCase(n),v) for n,v in changes ]
+			modOptionValuesOfCids(cids)
+
+	# Returns options set for case as dict, including default values of
+	# options not set if defaults is True
+	def options(self,caseName,defaults=False):
+		with self.use():
+			cid = verifyCase(caseName)
+			if defaults:
+				return getValuesOfOptionsOfCid(cid,getOptions('case'))
+
+			return dict(sqlCurs.execute('''
+				SELECT options.optionName,caseOptions.value
+				FROM caseOptions
+				JOIN options ON options.oid=caseOptions.oid
+				WHERE caseOptions.cid=? AND options.optionType=?''',
+				(cid,'case')))
+
+	# Builds and runs given cases, or all cases
+	def run(self,caseNames=None,jobs=None,timeout=None,link=None):
+		cmdOpts = self.cmdOpts('--force',jobs=jobs,timeout=timeout,link=link)
+		with self.use(cmdOpts):
+			runCids(self.cidsOf(caseNames))
+
+	# Sets default value of option
+	def setDefault(self,optName,value):
+		with self.use():
+			modOptionValue(optName,value)
 
-	# Delete file from option
-	if (isCmdLineArgument('--file','-F')) \
-		and (isCmdLineArgument('--option','-O')):
-		delFileFromOption(
-			getCmdLineArgument('--option','-O'),
-			getCmdLineArgument('--file','-F')
-		)
+#
+# Main -----------------------------------------------------------------
+#
 
-	# Delete option
-	elif isCmdLineArgument('--option','-O'):
-		delOption(getCmdLineArgument('--option','-O'))
-		
-	# Unspecified
-	else:
-		printHelpDelete()
+# Runs series as command line tool on a session for the data base
+def main(argv=None):
+	global opts,optNames,dbFile
 
-# Export
-elif isCmdLineArgument('--export'):
-	export()
+	if argv is None:
+		argv = sys.argv[1:]
 
-# Modify something
-elif isCmdLineArgument('--modify','-m'):
+	opts, args = getArgs(shortOpts,longOpts,argv)
 
-	# Modify name of option
-	if (isCmdLineArgument('--option','-O')) \
-		and isCmdLineArgument('--name'):
-		modOptionName(
-			getCmdLineArgument('--option','-O'),
-			getCmdLineArgument('--name')
-			)
+	if (len(opts) == 0):
+		printHelp()
+		sys.exit(1)
 
-	# Modify value of option
-	elif (isCmdLineArgument('--option','-O')) \
-		and (isCmdLineArgument('--value','-V')):
-		modOptionValue(
-			getCmdLineArgument('--option','-O'),
-			getCmdLineArgument('--value','-V')
-			)
+	optNames = [ o[0] for o in opts ]
 
-	# Unspecified
-	else:
-		printHelpModify()
+	if isCmdLineArgument('--help','-h'):
+		printHelp()
+		sys.exit(0)
 
-# Print something
-elif isCmdLineArgument('--print','-p'):
+	if isCmdLineArgument('--version'):
+		print("Version "+str(version))
+		sys.exit(0)
 
-	# Cases including default options
-	if isCmdLineArgument('--cases') and isCmdLineArgument('--default'):
-		printCases(True)
+	try:
+		if isCmdLineArgument('--createDB'):
+			createDB(getCmdLineArgument('--createDB'))
+			if not isCmdLineArgument('--import'):
+				sys.exit(0)
 
-	# Cases
-	elif isCmdLineArgument('--cases'): printCases()
-
-	# All files
-	elif isCmdLineArgument('--files'): printFiles()
-
-	# Print series options
-	elif isCmdLineArgument('--options') \
-	and isCmdLineArgument('--series','-s'):
-		printOptions('series')
-
-	# Print case and meta options
-	elif isCmdLineArgument('--options'):
-		print('Meta options')
-		printOptions('meta')
-		print('')
-		print('Regular options')
-		printOptions('case')
+			# Fill new data base
+			dbFile = getCmdLineArgument('--createDB') + ".db"
 
-	# Unspecified
-	else:
-		printHelpPrint()
+		else:
+			dbFile = findDbFile()
+
+		if isCmdLineArgument("--db"):
+			dbFile = getCmdLineArgument("--db")
+
+		if (dbFile is None) or not os.path.isfile(dbFile):
+			raise SeriesError("Cannot find database.")
+
+		# Let the daemon do the work if there is one
+		if not isCmdLineArgument('--daemon') \
+			and not isCmdLineArgument('--noDaemon') \
+			and not isCmdLineArgument('--createDB'):
+			status = forwardToDaemon(getSocketFile(dbFile),argv)
+			if status is not None:
+				sys.exit(status)
+
+		session = Session(dbFile)
+		with session.use(opts):
+			if isCmdLineArgument('--daemon'):
+				serveDaemon()
+			else:
+				runCommand()
+		session.close()
 
-# Reset DB to initial state
-elif isCmdLineArgument('--reset'):
-	resetTables()
+	except SeriesError as e:
+		print(e)
+		sys.exit(1)
 
-# Options incorrect
-else:
-	printHelp()
-	sys.exit(1)
+	sys.exit(0)
 
-sqlCon.commit()
-sqlCon.close()
-sys.exit(0)
+if __name__ == '__main__':
+	main()
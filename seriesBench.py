@@ -0,0 +1,265 @@
+#!/usr/bin/python
+
+#	This file is part of SERIES.
+#
+#	SERIES is an abstract tool to assist in doing repetitive work
+#	on the basis of templates that are copied and individually adapted.
+#
+#	Copyright (C) 2016 Paul Stephan Weber
+#
+#	SERIES is free software; you can redistribute it and/or modify
+#	it under the terms of the GNU General Public License as published by
+#	the Free Software Foundation; either version 3 of the License, or
+#	(at your option) any later version.
+#
+#	SERIES is distributed in the hope that it will be useful,
+#	but WITHOUT ANY WARRANTY; without even the implied warranty of
+#	MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#	GNU General Public License for more details.
+#
+#	You should have received a copy of the GNU General Public License
+#	along with this program; if not, write to the Free Software Foundation,
+#	Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301  USA
+
+# Benchmarks the main paths of series on a generated series and prints
+# the timings as JSON, e.g.
+#   seriesBench.py --cases=10000 --options=20 --files=4 --history=3
+
+#
+# Options --------------------------------------------------------------
+#
+defaults = {
+	'cases': 1000,
+	'options': 10,
+	'files': 2,
+	'history': 2,
+	'size': 16,
+	'builds': 10,
+	'repeat': 3,
+	}
+
+shortOpts = "ho:"
+longOpts = [ k+"=" for k in sorted(defaults) ] + ["dir=","help","output="]
+
+#
+# Functions ------------------------------------------------------------
+#
+import getopt
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+import sqlite3
+
+import series
+
+# Creates series in workDir with the given counts and returns a session
+# for it. Options are spread over the template files, each of the given
+# size in KiB. Every case gets history additional case instances
+def generateSeries(workDir,params):
+	templateDir = os.path.join(workDir,"templateDir")
+	os.mkdir(templateDir)
+
+	optNames = [ "O"+str(i) for i in range(params['options']) ]
+	fileNames = [ "f"+str(i)+".txt" for i in range(params['files']) ]
+
+	# Template files, each option in one of them. Filler lines are put in
+	# the middle, written in blocks, so files of any size can be generated
+	filler = "# filler line of a generated template file #\n"
+	blockLines = 1024*1024//len(filler)
+	block = filler*blockLines
+	for i,fileName in enumerate(fileNames):
+		tokens = [ "OPT_"+o for o in optNames[i::len(fileNames)] ]
+		lines = [ t+" = "+t+"\n" for t in tokens ]
+		size = len("".join(lines))
+		numFillers = max(0,-(-(params['size']*1024-size)//len(filler)))
+
+		with open(os.path.join(templateDir,fileName),'w') as f:
+			f.write("".join(lines[:len(lines)//2]))
+			for j in range(numFillers//blockLines):
+				f.write(block)
+			f.write(filler*(numFillers % blockLines))
+			f.write("".join(lines[len(lines)//2:]))
+
+	# Run file doing nothing
+	runFile = os.path.join(templateDir,"run.sh")
+	with open(runFile,'w') as f:
+		f.write("#!/bin/sh\ntrue\n")
+	os.chmod(runFile,0o755)
+
+	series.createDB("bench")
+	session = series.Session("bench.db",output=open(os.devnull,'w'))
+
+	session.addTemplate("templateDir")
+	session.addRunFile("run.sh")
+	for i,optName in enumerate(optNames):
+		session.addOption(optName,"0",fileNames[i % len(fileNames)])
+
+	caseNames = [ "case"+str(i) for i in range(params['cases']) ]
+	session.addCases([ (n,{ o: i for o in optNames[::2] })
+		for i,n in enumerate(caseNames) ])
+
+	for depth in range(params['history']):
+		session.modifyCases([ (n,{ optNames[0]: depth+1 })
+			for n in caseNames ])
+
+	return session,caseNames
+
+# Times func repeat times, returns timing entry for items handled per run
+def measure(func,repeat,items=1):
+	runs = []
+	for r in range(repeat):
+		start = timeit.default_timer()
+		func(r)
+		runs.append(timeit.default_timer()-start)
+
+	return {
+		'best': min(runs),
+		'mean': sum(runs)/len(runs),
+		'runs': runs,
+		'items': items,
+		'bestPerItem': min(runs)/items,
+		}
+
+# Times the main paths of series on the session, returns dict of entries
+def runBenchmarks(session,caseNames,params):
+	repeat = params['repeat']
+	builds = caseNames[:params['builds']]
+	timings = {}
+
+	def lookup(r):
+		with session.use():
+			for caseName in caseNames:
+				series.verifyCase(caseName)
+	timings['caseLookup'] = measure(lookup,repeat,len(caseNames))
+
+	def build(r):
+		with session.use(session.cmdOpts('--force',jobs=1)):
+			for caseName in builds:
+				series.buildCid(series.verifyCase(caseName))
+	timings['buildCid'] = measure(build,repeat,len(builds))
+
+	def run(r):
+		with session.use(session.cmdOpts('--force',jobs=1)):
+			for caseName in builds:
+				series.runCid(series.verifyCase(caseName))
+	timings['runCid'] = measure(run,repeat,len(builds))
+
+	def printCases(r):
+		with session.use(session.cmdOpts('--withOptions')):
+			series.printCases()
+	timings['printCases'] = measure(printCases,repeat,len(caseNames))
+
+	def export(r):
+		with session.use():
+			series.export()
+	timings['export'] = measure(export,repeat,len(caseNames))
+
+	def modOptionValue(r):
+		with session.use():
+			series.modOptionValue("O0",str(r+100))
+	timings['modOptionValue'] = measure(modOptionValue,repeat,len(caseNames))
+
+	# Deletes another option each time
+	def delOption(r):
+		session.deleteOption("O"+str(params['options']-1-r))
+	repeatDel = min(repeat,params['options'])
+	timings['delOption'] = measure(delOption,repeatDel,len(caseNames))
+
+	return timings
+
+# Prints usage
+def printHelp():
+	print("Usage: seriesBench.py [--option=value ...]")
+	print("")
+	print("Generates a series and prints timings of its main paths as JSON.")
+	print("")
+	for k in sorted(defaults):
+		print("\t--"+k+"\t(default: "+str(defaults[k])+")")
+	print("\t--dir\t\tKeeps generated series in given directory")
+	print("\t--output (-o)\tWrites JSON to given file")
+
+#
+# Main -----------------------------------------------------------------
+#
+def main(argv=None):
+	if argv is None:
+		argv = sys.argv[1:]
+
+	try:
+		opts,args = getopt.getopt(argv,shortOpts,longOpts)
+	except getopt.GetoptError as e:
+		print(e)
+		printHelp()
+		sys.exit(1)
+
+	params = dict(defaults)
+	workDir = None
+	output = None
+	for opt,val in opts:
+		if opt in ('--help','-h'):
+			printHelp()
+			sys.exit(0)
+		elif (opt == '--dir'):
+			workDir = os.path.abspath(val)
+		elif opt in ('--output','-o'):
+			output = val
+		else:
+			if not val.isdigit():
+				print("Not a valid number ("+opt+"="+val+")")
+				sys.exit(1)
+			params[opt[2:]] = int(val)
+
+	if (params['files'] < 1) or (params['repeat'] < 1):
+		print("Need at least one file and one repetition")
+		sys.exit(1)
+
+	# Series works on the current directory
+	keep = workDir is not None
+	if keep:
+		os.makedirs(workDir)
+	else:
+		workDir = tempfile.mkdtemp(prefix="seriesBench-")
+	cwd = os.getcwd()
+	os.chdir(workDir)
+
+	try:
+		start = timeit.default_timer()
+		session,caseNames = generateSeries(workDir,params)
+		generated = timeit.default_timer()-start
+
+		timings = runBenchmarks(session,caseNames,params)
+		session.close()
+
+	except series.SeriesError as e:
+		print(e)
+		sys.exit(1)
+
+	finally:
+		os.chdir(cwd)
+		if not keep:
+			shutil.rmtree(workDir)
+
+	result = {
+		'version': series.version,
+		'python': platform.python_version(),
+		'sqlite': sqlite3.sqlite_version,
+		'platform': platform.platform(),
+		'params': params,
+		'generate': generated,
+		'timings': timings,
+		}
+
+	text = json.dumps(result,indent=1,sort_keys=True)
+	if output:
+		with open(output,'w') as f:
+			f.write(text+"\n")
+	else:
+		print(text)
+
+if __name__ == '__main__':
+	main()